@@ -0,0 +1,104 @@
+"""
+T3 decode speed and intelligibility of CFG schedules.
+
+Full CFG runs every decode step on twice the rows. A schedule guides only the first `cfg_steps` speech tokens,
+and / or refreshes the unconditional logits every `cfg_interval` steps. Each setting decodes all sentences as one
+batch (speech tokens per second of T3 alone), renders them with S3Gen, and scores the audio with the Whisper check of
+`TextToSpeech.check_tts_batch` (1.0 is a perfect transcription).
+
+    python -m benchmarks.cfg_schedules --voice input/reference1.wav
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from src.chatterbox.tts import punc_norm
+from src.text_to_speech import TextToSpeech
+
+SENTENCES = [
+    "She closed the door behind her and listened.",
+    "The rain had not stopped for three days, and the river was already higher than anyone in the village could remember.",
+    "He told them everything he knew, which was not much, and then he waited for the questions that he was sure would come.",
+    "Nobody answered.",
+    "By the time the lamps were lit, the market square was empty except for a dog asleep under the fountain.",
+    "It was, she decided, the worst idea she had ever had, and also the only one.",
+]
+
+# (name, cfg_weight, cfg_steps, cfg_interval)
+SETTINGS = [
+    ("full", 0.5, None, 1),
+    ("no cfg", 0.0, None, 1),
+    ("first 200", 0.5, 200, 1),
+    ("first 100", 0.5, 100, 1),
+    ("first 50", 0.5, 50, 1),
+    ("every 2", 0.5, None, 2),
+    ("every 4", 0.5, None, 4),
+    ("first 100, every 2", 0.5, 100, 2),
+    ("first 200, every 4", 0.5, 200, 4),
+]
+
+
+def batch_text_tokens(model, texts: list[str], cfg: bool):
+    """Padded text tokens and lengths of `texts`, as `ChatterboxTTS.generate` prepares them."""
+    sot, eot = model.t3.hp.start_text_token, model.t3.hp.stop_text_token
+    text_tokens = []
+    for text in texts:
+        tokens = model.tokenizer.text_to_tokens(punc_norm(text)).squeeze(0).to(model.device)
+        text_tokens.append(F.pad(F.pad(tokens, (1, 0), value=sot), (0, 1), value=eot))
+    text_token_lens = torch.tensor([len(t) for t in text_tokens], dtype=torch.long, device=model.device)
+    text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True, padding_value=eot)
+    if cfg:
+        return torch.cat([text_tokens, text_tokens]), torch.cat([text_token_lens, text_token_lens])
+    return text_tokens, text_token_lens
+
+
+def timed_decode(model, cfg_weight: float, cfg_steps, cfg_interval: int):
+    text_tokens, text_token_lens = batch_text_tokens(model, SENTENCES, cfg_weight > 0.0)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    speech_tokens = model.t3.inference(t3_cond=model.conds.t3, text_tokens=text_tokens,
+                                       text_token_lens=text_token_lens, max_new_tokens=1000, max_cache_len=1500,
+                                       temperature=0.8, repetition_penalty=1.0, cfg_weight=cfg_weight,
+                                       cache_cond_prefix=True, cfg_steps=cfg_steps, cfg_interval=cfg_interval)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return speech_tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default="input/reference1.wav")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    tts = TextToSpeech(device=args.device)
+    model = tts.model
+    model.prepare_conditionals(args.voice)
+
+    print(f"{'schedule':>20} {'tokens':>7} {'tokens/s':>9} {'speedup':>8} {'score':>6} {'min':>6}")
+    baseline = None
+    with torch.inference_mode():
+        for name, cfg_weight, cfg_steps, cfg_interval in SETTINGS:
+            # an untimed run compiles the decode step for this batch shape
+            timed_decode(model, cfg_weight, cfg_steps, cfg_interval)
+            n_tokens, elapsed, scores = 0, 0.0, []
+            for repeat in range(args.repeats):
+                torch.manual_seed(repeat)
+                speech_tokens, t = timed_decode(model, cfg_weight, cfg_steps, cfg_interval)
+                elapsed += t
+                # tokens up to each row's EOS: rows that finish early do not count as decoded speech
+                n_tokens += sum(len(model._clean_speech_tokens(row)) for row in speech_tokens)
+                wavs = list(model._speech_to_wavs(speech_tokens, batch_size=len(SENTENCES)))
+                scores += tts.check_tts_batch(SENTENCES, wavs)
+            rate = n_tokens / elapsed
+            baseline = baseline or rate
+            print(f"{name:>20} {n_tokens // args.repeats:7d} {rate:9.1f} {rate / baseline:7.2f}x "
+                  f"{sum(scores) / len(scores):6.3f} {min(scores):6.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Mel distance and wall time of the S3Gen CFM decoder for different ODE solvers, step counts and time schedules.
+
+The speech tokens of every sentence are generated once with T3. Each setting then renders their mels, which are
+compared (mean absolute error, log-mel units) with the 10-step Euler / cosine reference. The decoder starts from
+a fixed noise, so the differences come from the integration only.
+
+    python -m benchmarks.cfm_solvers --voice input/reference1.wav
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from src.chatterbox.models.s3gen.flow_matching import SOLVERS
+from src.chatterbox.tts import ChatterboxTTS
+
+SENTENCES = [
+    "She closed the door behind her and listened.",
+    "The rain had not stopped for three days, and the river was already higher than anyone in the village could remember.",
+    "He told them everything he knew, which was not much, and then he waited for the questions that he was sure would come.",
+]
+
+SETTINGS = [
+    ("euler", 10, "cosine"),
+    ("euler", 6, "cosine"),
+    ("euler", 4, "cosine"),
+    ("midpoint", 3, "cosine"),
+    ("heun", 3, "cosine"),
+    ("heun", 2, "cosine"),
+    ("multistep", 6, "cosine"),
+    ("multistep", 4, "cosine"),
+    ("multistep", 4, "linear"),
+    ("multistep", 3, "cosine"),
+]
+
+
+def timed_mels(model: ChatterboxTTS, tokens: torch.Tensor, solver: str, steps: int, schedule: str):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    mels = model.s3gen.flow_inference(tokens, ref_dict=model.conds.gen, finalize=True, n_timesteps=steps,
+                                      solver=solver, t_scheduler=schedule)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mels.float(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default="input/reference1.wav")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    model.prepare_conditionals(args.voice)
+
+    # T3 runs once per sentence, so that every setting renders the same speech tokens
+    torch.manual_seed(0)
+    sot, eot = model.t3.hp.start_text_token, model.t3.hp.stop_text_token
+    tokens_per_sentence = []
+    with torch.inference_mode():
+        for text in SENTENCES:
+            text_tokens = model.tokenizer.text_to_tokens(text).to(model.device)
+            text_tokens = F.pad(F.pad(text_tokens, (1, 0), value=sot), (0, 1), value=eot)
+            tokens = model.t3.inference(t3_cond=model.conds.t3, text_tokens=text_tokens, max_new_tokens=1000,
+                                        max_cache_len=1500)
+            tokens_per_sentence.append(model._clean_speech_tokens(tokens[0]))
+
+    references = [timed_mels(model, tokens, "euler", 10, "cosine")[0] for tokens in tokens_per_sentence]
+
+    print(f"{'solver':>10} {'steps':>5} {'schedule':>8} {'NFE':>4} {'time (s)':>9} {'speedup':>8} {'mel L1':>7}")
+    baseline = None
+    for solver, steps, schedule in SETTINGS:
+        elapsed, distances = 0.0, []
+        for tokens, reference in zip(tokens_per_sentence, references):
+            for _ in range(args.repeats):
+                mels, t = timed_mels(model, tokens, solver, steps, schedule)
+                elapsed += t
+            distances.append((mels - reference).abs().mean().item())
+        elapsed /= args.repeats
+        baseline = baseline or elapsed
+        print(f"{solver:>10} {steps:>5} {schedule:>8} {steps * SOLVERS[solver]:>4} {elapsed:9.3f} "
+              f"{baseline / elapsed:7.2f}x {sum(distances) / len(distances):7.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Per-step time histogram of the T3 decode loop, and the share of it that is not the transformer forward (sampling,
+logits processing, Python overhead, host syncs).
+
+Runs the compiled model of `TextToSpeech` on single sentences and on the whole list as one batch, and prints
+`T3.last_step_stats` of each run.
+
+    python -m benchmarks.decode_steps --voice input/reference1.wav
+"""
+import argparse
+
+import torch
+
+from src.text_to_speech import TextToSpeech
+
+SENTENCES = [
+    "She closed the door behind her and listened.",
+    "The rain had not stopped for three days, and the river was already higher than anyone in the village could remember.",
+    "He told them everything he knew, which was not much, and then he waited for the questions that he was sure would come.",
+    "By the time the lamps were lit, the market square was empty except for a dog asleep under the fountain.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default="input/reference1.wav")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args()
+
+    tts = TextToSpeech(device=args.device, stt_model_name=None)
+    model = tts.model
+    model.prepare_conditionals(args.voice)
+
+    runs = [(f"sentence {i + 1}", text) for i, text in enumerate(SENTENCES)] + [("batch", SENTENCES)]
+    with torch.inference_mode():
+        # compiles the decode step for both batch sizes
+        for _, text in runs[-2:]:
+            list(model.generate(text, step_timing=True))
+
+        for name, text in runs:
+            torch.manual_seed(0)
+            list(model.generate(text, step_timing=True))
+            stats = model.t3.last_step_stats
+            print(f"{name}: {stats['steps']} steps, {stats['total_ms'] / stats['steps']:.2f} ms/step "
+                  f"(p50 {stats['p50_ms']:.2f}, p90 {stats['p90_ms']:.2f}, p99 {stats['p99_ms']:.2f}), "
+                  f"forward {stats['forward_ms'] / stats['steps']:.2f} ms/step, "
+                  f"overhead {stats['overhead_fraction']:.1%}")
+            print("    " + "  ".join(f"{bucket}: {n}" for bucket, n in stats["histogram"].items() if n))
+
+
+if __name__ == "__main__":
+    main()
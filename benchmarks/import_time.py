@@ -0,0 +1,54 @@
+"""
+Import-time profile of the synthesis entry points, from `python -X importtime` in a fresh interpreter.
+
+Prints the slowest imports by cumulative time, and fails (exit code 1) if a subsystem that should only load on
+first use (Whisper, NeMo text normalization) is imported eagerly.
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules src.text_preprocess --top 30
+"""
+import argparse
+import subprocess
+import sys
+
+DEFERRED = ["whisper", "nemo_text_processing"]
+
+
+def profile(modules: list[str]) -> list[tuple[int, int, str]]:
+    """(self us, cumulative us, module) of every import done by importing `modules`."""
+    code = "; ".join(f"import {m}" for m in modules)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"Importing {', '.join(modules)} failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", default="src.text_to_speech,src.text_preprocess")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    imports = profile(args.modules.split(","))
+    total = sum(self_us for self_us, _, _ in imports)
+    print(f"{len(imports)} modules imported in {total / 1e6:.2f}s")
+    print(f"{'cumulative (s)':>14} {'self (s)':>9}  module")
+    for self_us, cumulative_us, name in sorted(imports, key=lambda i: -i[1])[:args.top]:
+        print(f"{cumulative_us / 1e6:14.3f} {self_us / 1e6:9.3f}  {name}")
+
+    eager = sorted({name.strip() for _, _, name in imports if name.strip().split(".")[0] in DEFERRED})
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        sys.exit(1)
+    print(f"OK: {', '.join(DEFERRED)} not imported")
+
+
+if __name__ == "__main__":
+    main()
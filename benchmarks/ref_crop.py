@@ -0,0 +1,86 @@
+"""
+Real-time factor vs. speaker similarity of S3Gen for different reference prompt crops.
+
+The speech tokens of every sentence are generated once with T3, then rendered by S3Gen with the full reference
+and with shorter crops. Speaker similarity is the cosine similarity between the CAMPPlus x-vector of the output and
+that of the reference. "RTF cold" clears the S3Gen prompt cache before every render, so the difference to "RTF" is
+what the cache saves per chunk.
+
+    python -m benchmarks.ref_crop --voice input/reference1.wav
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from src.chatterbox.models.s3gen import S3GEN_SR
+from src.chatterbox.models.s3gen.s3gen import get_resampler
+from src.chatterbox.models.s3tokenizer import S3_SR
+from src.chatterbox.tts import ChatterboxTTS
+
+SENTENCES = [
+    "Yes.",
+    "She closed the door behind her and listened.",
+    "The rain had not stopped for three days, and the river was already higher than anyone in the village could remember.",
+    "He told them everything he knew, which was not much, and then he waited for the questions that he was sure would come.",
+]
+
+
+def speaker_similarity(model: ChatterboxTTS, wav: torch.Tensor) -> float:
+    wav_16 = get_resampler(S3GEN_SR, S3_SR, model.device)(wav.to(model.device))
+    emb = model.s3gen.speaker_encoder.inference(wav_16)
+    return F.cosine_similarity(emb, model.conds.gen["embedding"].to(emb)).item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default="input/reference1.wav")
+    parser.add_argument("--crops", default="full,200,150,100,75,50,25,auto",
+                        help="Comma separated prompt lengths in tokens (25 / s), 'full' or 'auto'")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    model.prepare_conditionals(args.voice)
+    print(f"Reference prompt: {model.conds.gen['prompt_token'].shape[1]} tokens")
+
+    # T3 runs once per sentence, so that every crop renders the same speech tokens
+    torch.manual_seed(0)
+    sot, eot = model.t3.hp.start_text_token, model.t3.hp.stop_text_token
+    tokens_per_sentence = []
+    with torch.inference_mode():
+        for text in SENTENCES:
+            text_tokens = model.tokenizer.text_to_tokens(text).to(model.device)
+            text_tokens = F.pad(F.pad(text_tokens, (1, 0), value=sot), (0, 1), value=eot)
+            tokens = model.t3.inference(t3_cond=model.conds.t3, text_tokens=text_tokens, max_new_tokens=1000,
+                                        max_cache_len=1500)
+            tokens_per_sentence.append(tokens[0])
+
+    print(f"{'crop':>6} {'RTF':>7} {'RTF cold':>9} {'similarity':>11}")
+    for crop in args.crops.split(","):
+        ref_crop = None if crop == "full" else crop if crop == "auto" else int(crop)
+        elapsed = dict(warm=0.0, cold=0.0)
+        audio_seconds, similarities = 0.0, []
+        for tokens in tokens_per_sentence:
+            for _ in range(args.repeats):
+                # the cold render fills the cache for the warm one
+                for cache in ("cold", "warm"):
+                    if cache == "cold":
+                        model.s3gen.flow.clear_prompt_cache()
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                    wav = model._speech_to_wav(tokens, ref_crop=ref_crop)
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    elapsed[cache] += time.perf_counter() - start
+                audio_seconds += wav.shape[-1] / model.sr
+            similarities.append(speaker_similarity(model, wav))
+        print(f"{crop:>6} {elapsed['warm'] / audio_seconds:7.3f} {elapsed['cold'] / audio_seconds:9.3f} "
+              f"{sum(similarities) / len(similarities):11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Time per decode step of the T3 sampling, in isolation: the logits processors of the original decode loop
+(`RepetitionPenaltyLogitsProcessor` over the padded token history, `TopPLogitsWarper`, softmax, `torch.multinomial`)
+against `SpeechTokenSampler`.
+
+Both sample a full-length decode from fixed logits drawn to look like T3's (a few likely tokens over a long tail).
+The total variation distance between their next-token distributions at the last step checks that the fused path
+samples the same distribution (it only differs when the `top_k` candidates hold less than `top_p`).
+
+    python -m benchmarks.sampler
+    python -m benchmarks.sampler --device cpu --rows 1,4
+"""
+import argparse
+import time
+
+import torch
+from transformers.generation.logits_process import RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from src.chatterbox.models.t3.inference.sampler import SpeechTokenSampler
+from src.chatterbox.models.t3.modules.t3_config import T3Config
+
+TEMPERATURE = 0.8
+TOP_P = 0.8
+REPETITION_PENALTY = 1.2
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def fake_logits(steps: int, n_rows: int, vocab_size: int, device) -> torch.Tensor:
+    logits = torch.randn(steps, n_rows, vocab_size, device=device) * 2.0
+    # a handful of likely tokens per step
+    likely = torch.randint(0, 6561, (steps, n_rows, 8), device=device)
+    logits.scatter_add_(2, likely, torch.full(likely.shape, 6.0, device=device))
+    return logits.to(torch.bfloat16)
+
+
+def hf_decode(logits: torch.Tensor, bos: int, pad: int):
+    steps, n_rows, _ = logits.shape
+    generated_ids = torch.full((n_rows, steps + 1), pad, dtype=torch.long, device=logits.device)
+    generated_ids[:, 0] = bos
+    top_p_warper = TopPLogitsWarper(top_p=TOP_P)
+    repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=REPETITION_PENALTY)
+    for i in range(steps):
+        step_logits = logits[i] / TEMPERATURE
+        step_logits = repetition_penalty_processor(generated_ids, step_logits)
+        step_logits = top_p_warper(None, step_logits)
+        probs = torch.softmax(step_logits, dim=-1)
+        generated_ids[:, i + 1] = torch.multinomial(probs, num_samples=1)[:, 0]
+    return generated_ids, probs.float()
+
+
+def fused_decode(sampler: SpeechTokenSampler, logits: torch.Tensor, bos: int):
+    steps, n_rows, _ = logits.shape
+    generated_ids = torch.empty((n_rows, steps + 1), dtype=torch.long, device=logits.device)
+    generated_ids[:, 0] = bos
+    sampler.reset(TEMPERATURE, TOP_P, REPETITION_PENALTY, seeds=list(range(n_rows)), history=generated_ids[:, :1])
+    for i in range(steps):
+        generated_ids[:, i + 1] = sampler(logits[i])[:, 0]
+    # next-token distribution of the last step, from the sampler workspaces
+    probs = torch.zeros(logits.shape[1:], device=logits.device)
+    probs.scatter_(1, sampler.top_ids, sampler.probs)
+    return generated_ids, probs / probs.sum(dim=-1, keepdim=True)
+
+
+def timed(fn, device, repeats):
+    fn()  # warm up
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    synchronize(device)
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--rows", default="1,4,16")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    hp = T3Config()
+    vocab_size, bos, pad = hp.speech_tokens_dict_size, hp.start_speech_token, hp.stop_speech_token + 1
+
+    print(f"{'rows':>4} {'HF (us/step)':>13} {'fused (us/step)':>16} {'speedup':>8} {'TV distance':>12}")
+    for n_rows in map(int, args.rows.split(",")):
+        torch.manual_seed(0)
+        logits = fake_logits(args.steps, n_rows, vocab_size, device)
+        sampler = SpeechTokenSampler(n_rows, vocab_size, device, top_k=args.top_k)
+
+        _, hf_time = timed(lambda: hf_decode(logits, bos, pad), device, args.repeats)
+        (fused_ids, fused_probs), fused_time = timed(lambda: fused_decode(sampler, logits, bos), device, args.repeats)
+
+        # same history (without PAD) and logits on both sides for the distribution check
+        step_logits = logits[-1].float() / TEMPERATURE
+        step_logits = RepetitionPenaltyLogitsProcessor(penalty=REPETITION_PENALTY)(fused_ids[:, :-1], step_logits)
+        reference = torch.softmax(TopPLogitsWarper(top_p=TOP_P)(None, step_logits).float(), dim=-1)
+        tv = 0.5 * (reference - fused_probs).abs().sum(dim=-1).max().item()
+
+        print(f"{n_rows:4d} {hf_time / args.steps * 1e6:13.1f} {fused_time / args.steps * 1e6:16.1f} "
+              f"{hf_time / fused_time:7.2f}x {tv:12.2e}")
+
+
+if __name__ == "__main__":
+    main()
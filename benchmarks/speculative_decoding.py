@@ -0,0 +1,104 @@
+"""
+Speed and acceptance of speculative T3 decoding.
+
+Each setting synthesizes every sentence on its own with `ChatterboxTTS.generate`. T3 tokens/s counts the speech
+tokens decoded per second of `T3.inference`, end-to-end tokens/s per second of the whole `generate` call, including
+S3Gen. Acceptance is the share of drafted tokens that the full model kept (`T3.last_speculative_stats`), and
+"per fwd" the tokens gained per full-model forward pass.
+
+On CPU the decode loop is bound by memory bandwidth, which is where checking several tokens in one forward pass
+pays off most:
+
+    python -m benchmarks.speculative_decoding --voice input/reference1.wav --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from src.chatterbox.tts import ChatterboxTTS
+
+SENTENCES = [
+    "She closed the door behind her and listened.",
+    "The rain had not stopped for three days, and the river was already higher than anyone in the village could remember.",
+    "He told them everything he knew, which was not much, and then he waited for the questions that he was sure would come.",
+]
+
+# (speculative, draft_tokens, draft layers)
+SETTINGS = [
+    (None, 0, None),
+    ("ngram", 4, None),
+    ("ngram", 8, None),
+    ("layers", 2, 8),
+    ("layers", 4, 8),
+    ("layers", 4, 4),
+    ("layers", 4, 12),
+]
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice", default="input/reference1.wav")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    model.prepare_conditionals(args.voice)
+    t3_inference = model.t3.inference
+    t3_totals = dict(tokens=0, seconds=0.0)
+
+    def timed_t3_inference(**kwargs):
+        synchronize()
+        start = time.perf_counter()
+        tokens = t3_inference(**kwargs)
+        synchronize()
+        t3_totals["seconds"] += time.perf_counter() - start
+        t3_totals["tokens"] += len(model._clean_speech_tokens(tokens[0]))
+        return tokens
+
+    model.t3.inference = timed_t3_inference
+
+    print(f"{'draft':>8} {'k':>2} {'layers':>6} {'tokens':>7} {'accept':>7} {'per fwd':>7} "
+          f"{'T3 tok/s':>9} {'speedup':>8} {'e2e tok/s':>9}")
+    baseline = None
+    for speculative, draft_tokens, draft_layers in SETTINGS:
+        if draft_layers is not None:
+            model.t3.DRAFT_LAYERS = draft_layers
+        elapsed, rounds, drafted, accepted = 0.0, 0, 0, 0
+        t3_totals.update(tokens=0, seconds=0.0)
+        for repeat in range(args.repeats):
+            for text in SENTENCES:
+                torch.manual_seed(repeat)
+                synchronize()
+                start = time.perf_counter()
+                next(model.generate(text, cfg_weight=args.cfg_weight, speculative=speculative,
+                                     draft_tokens=draft_tokens))
+                synchronize()
+                elapsed += time.perf_counter() - start
+                if speculative is None:
+                    continue
+                stats = model.t3.last_speculative_stats
+                rounds += stats["rounds"]
+                drafted += stats["drafted"]
+                accepted += stats["accepted"]
+
+        # plain decoding does one forward per token
+        n_tokens = t3_totals["tokens"]
+        per_forward = n_tokens / rounds if rounds else 1.0
+        acceptance = f"{accepted / drafted:7.2f}" if drafted else f"{'-':>7}"
+        rate = n_tokens / t3_totals["seconds"]
+        baseline = baseline or rate
+        print(f"{speculative or 'none':>8} {draft_tokens:>2} {draft_layers or '-':>6} {n_tokens // args.repeats:7d} "
+              f"{acceptance} {per_forward:7.2f} {rate:9.1f} {rate / baseline:7.2f}x {n_tokens / elapsed:9.1f}")
+    model.t3.inference = t3_inference
+
+
+if __name__ == "__main__":
+    main()
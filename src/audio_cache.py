@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class AudioCache:
+    """
+    A content-addressed store of synthesized audio, so that text that was already rendered with the same voice,
+    parameters and model (headings, scene breaks, repeated dialogue tags, unchanged chunks of a revised
+    manuscript) is not synthesized again.
+
+    Audio is kept as 16-bit PCM in a single SQLite database. Once the stored audio exceeds `max_bytes`, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 2 << 30):
+        """
+        Args:
+            path (str): Path of the SQLite database. Created if missing.
+            max_bytes (int): Size cap of the stored audio, in bytes.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # a busy writer in another thread or process makes us wait instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS audio (
+                key TEXT PRIMARY KEY,
+                pcm BLOB NOT NULL,
+                num_bytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS audio_last_used ON audio (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(text: str, **params) -> str:
+        """
+        Key of a chunk: its normalized text and everything else the audio depends on (voice hash, generation
+        parameters, seed, model checksum). Parameters must be JSON serializable.
+        """
+        payload = json.dumps(dict(text=text, **params), sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / lookups if lookups else 0.0,
+                    num_bytes=self.num_bytes())
+
+    def num_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(num_bytes), 0) FROM audio").fetchone()[0]
+
+    def get(self, key: str):
+        """Returns the cached (1, T) float waveform, or None."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT pcm FROM audio WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE audio SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        pcm = np.frombuffer(row[0], dtype=np.int16)
+        return torch.from_numpy(pcm.astype(np.float32) / 32767.0).unsqueeze(0)
+
+    def put(self, key: str, wav: torch.Tensor):
+        """Stores a waveform in [-1, 1] and evicts the least recently used entries above the size cap."""
+        pcm = (wav.detach().float().cpu().clamp(-1, 1) * 32767.0).round().to(torch.int16).numpy().tobytes()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO audio VALUES (?, ?, ?, ?)", (key, pcm, len(pcm), time.time()))
+            total = self._conn.execute("SELECT SUM(num_bytes) FROM audio").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = 0
+            for old_key, n in self._conn.execute("SELECT key, num_bytes FROM audio ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM audio WHERE key = ?", (old_key,))
+                total -= n
+                evicted += 1
+            logger.debug(f"audio cache: evicted {evicted} entries")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,183 @@
+import copy
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Optional
+
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST = Path(os.environ.get("CHATTERBOX_MANIFEST", Path.home() / ".cache" / "chatterbox" / "manifest.json"))
+
+
+# Whether modules built in the current thread / context get meta parameters, see `params_on_meta`
+_params_on_meta = ContextVar("params_on_meta", default=False)
+_register_parameter = torch.nn.Module.register_parameter
+
+
+def _register_parameter_maybe_on_meta(module, name, param):
+    _register_parameter(module, name, param)
+    if _params_on_meta.get() and param is not None and not param.is_meta:
+        module._parameters[name] = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+
+
+@contextmanager
+def params_on_meta():
+    """
+    Modules built in this context get their parameters on the meta device, so their random initialization costs
+    nothing, and `load_state_dict(..., assign=True)` later puts the checkpoint tensors in their place.
+
+    Buffers and plain tensor attributes (mel filters, rotary frequencies, fixed noise, fade windows) are still
+    built on the CPU as usual: most of them are not in the checkpoints.
+
+    Only the current thread (context) is affected: modules built concurrently elsewhere, e.g. a lazily loaded
+    speech recognition model, are initialized as usual.
+    """
+    torch.nn.Module.register_parameter = _register_parameter_maybe_on_meta
+    token = _params_on_meta.set(True)
+    try:
+        yield
+    finally:
+        _params_on_meta.reset(token)
+
+
+def _init_missing(module: torch.nn.Module, missing: list[str], build, dtype) -> bool:
+    """
+    Gives the `missing` (meta) parameters of `module` a regular initialization, in place. A parameter of a leaf
+    module with `reset_parameters` (linear, conv, norm and embedding layers) is initialized by running it on a
+    copy of that module. Otherwise only a regular build of the whole module knows its initialization: one is made
+    and the parameters are taken from it. Returns whether that was needed.
+    """
+    owners = {}
+    for name in missing:
+        prefix, _, leaf = name.rpartition(".")
+        owners.setdefault(prefix, []).append(leaf)
+
+    initialized, full_build = {}, []
+    for prefix, leaves in owners.items():
+        owner = module.get_submodule(prefix)
+        if not hasattr(owner, "reset_parameters") or next(owner.children(), None) is not None:
+            full_build += [f"{prefix}.{leaf}" if prefix else leaf for leaf in leaves]
+            continue
+        # a copy with fresh parameters (and buffers, e.g. running stats), so that the loaded ones are left alone
+        fresh = copy.copy(owner)
+        fresh._parameters = {
+            k: None if p is None else torch.nn.Parameter(torch.empty_like(p, device="cpu"), p.requires_grad)
+            for k, p in owner._parameters.items()
+        }
+        fresh._buffers = {k: None if b is None else b.clone() for k, b in owner._buffers.items()}
+        fresh.reset_parameters()
+        for leaf in leaves:
+            initialized[f"{prefix}.{leaf}" if prefix else leaf] = fresh._parameters[leaf]
+    if full_build:
+        built = dict(build().named_parameters())
+        initialized.update({name: built[name] for name in full_build})
+
+    for name, param in initialized.items():
+        prefix, _, leaf = name.rpartition(".")
+        param = param.detach()
+        if dtype is not None and param.is_floating_point():
+            param = param.to(dtype)
+        owner = module.get_submodule(prefix)
+        meta = owner._parameters[leaf]
+        owner._parameters[leaf] = type(meta)(param, requires_grad=meta.requires_grad)
+    return bool(full_build)
+
+
+def load_module(
+    build: Callable[[], torch.nn.Module],
+    ckpt_fpath,
+    device,
+    dtype: Optional[torch.dtype] = None,
+    strict: bool = True,
+    state_fn: Optional[Callable[[dict], dict]] = None,
+    stats: Optional[dict] = None,
+    stats_key: str = "module",
+) -> torch.nn.Module:
+    """
+    Builds a module with `build()` without initializing its parameters, and assigns the tensors of a safetensors
+    checkpoint to them. The checkpoint is memory-mapped and, on CUDA, read straight to the device, so the weights
+    are never copied on the CPU.
+
+    Args:
+        build: Constructor of the module, e.g. `T3`.
+        ckpt_fpath: Path of the safetensors checkpoint.
+        device: Target device.
+        dtype: If given, floating point tensors are cast to it before assignment (instead of casting the module).
+        strict: As in `load_state_dict`. Parameters missing from the checkpoint get a regular initialization,
+            see `_init_missing`.
+        state_fn: Applied to the loaded state dict before assignment, e.g. to unwrap it.
+        stats: If given, the seconds spent initializing missing parameters are recorded in it, as
+            "<stats_key> missing init", or "<stats_key> full build" if a regular build of the module was needed.
+    """
+    with params_on_meta():
+        module = build()
+
+    load_device = str(device) if str(device).startswith("cuda") else "cpu"
+    state = load_file(ckpt_fpath, device=load_device)
+    if state_fn is not None:
+        state = state_fn(state)
+    if dtype is not None:
+        state = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state.items()}
+    module.load_state_dict(state, strict=strict, assign=True)
+
+    missing = [name for name, param in module.named_parameters() if param.is_meta]
+    if missing:
+        start = time.perf_counter()
+        full_build = _init_missing(module, missing, build, dtype)
+        elapsed = time.perf_counter() - start
+        logger.warning(f"{len(missing)} parameters are not in {ckpt_fpath} and were initialized"
+                       f"{' by a full build' if full_build else ''} ({elapsed:.2f}s): "
+                       f"{', '.join(missing[:5])}{', ...' if len(missing) > 5 else ''}")
+        if stats is not None:
+            stats[f"{stats_key} {'full build' if full_build else 'missing init'}"] = elapsed
+
+    return module.to(device=device).eval()
+
+
+def resolve_checkpoint(repo_id: str, files: list[str], manifest_path=DEFAULT_MANIFEST) -> Path:
+    """
+    Directory of the checkpoint `files` of `repo_id`, without touching the hub if possible.
+
+    The local manifest records where the files were last found and their sizes. If they are all still there, that
+    directory is used as is. Otherwise the files are looked up in the local hub cache, downloaded only if missing,
+    and the manifest is updated.
+    """
+    manifest_path = Path(manifest_path)
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            manifest = json.loads(manifest_path.read_text())
+        except ValueError:
+            logger.warning(f"Ignoring unreadable model manifest {manifest_path}")
+
+    entry = manifest.get(repo_id)
+    if entry is not None:
+        ckpt_dir = Path(entry["ckpt_dir"])
+        sizes = entry["files"]
+        if all(f in sizes and (ckpt_dir / f).is_file() and (ckpt_dir / f).stat().st_size == sizes[f] for f in files):
+            return ckpt_dir
+
+    paths = []
+    for fpath in files:
+        try:
+            paths.append(Path(hf_hub_download(repo_id=repo_id, filename=fpath, local_files_only=True)))
+        except Exception:
+            paths.append(Path(hf_hub_download(repo_id=repo_id, filename=fpath)))
+    ckpt_dir = paths[-1].parent
+
+    sizes = dict(entry["files"]) if entry is not None and entry["ckpt_dir"] == str(ckpt_dir) else {}
+    sizes.update({p.name: p.stat().st_size for p in paths})
+    manifest[repo_id] = dict(ckpt_dir=str(ckpt_dir), files=sizes, updated=time.time())
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_path, manifest_path)
+    return ckpt_dir
@@ -11,6 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -34,6 +36,39 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
 
 
 
+@dataclass
+class PreparedConditioning:
+    """
+    Everything `ConditionalDecoder` computes from its inputs except `x`, for one utterance:
+    - masks / attn_biases: padding masks and attention biases of the down, mid and up blocks
+    - cond_x: the conditioning channels (mu, repeated spks, cond)
+    - conv1_cond / res_cond: their contribution (plus bias) to the two linear convolutions of the first block
+    - time_emb / resnet_time_emb: time embeddings of every evaluation time, and their projection by each resnet,
+      indexed as [time index, batch]
+    """
+    mask: torch.Tensor
+    down_masks: list
+    down_biases: list
+    mid_mask: torch.Tensor
+    mid_bias: torch.Tensor
+    up_masks: list
+    up_biases: list
+    cond_x: torch.Tensor
+    conv1_weight: torch.Tensor
+    conv1_cond: torch.Tensor
+    res_weight: torch.Tensor
+    res_cond: torch.Tensor
+    time_emb: torch.Tensor
+    resnet_time_emb: list
+
+
+def _conv(conv: torch.nn.Conv1d, x: torch.Tensor, weight: torch.Tensor, bias=None) -> torch.Tensor:
+    "`conv` applied with another weight, e.g. a slice of its input channels."
+    if isinstance(conv, CausalConv1d):
+        x = F.pad(x, conv.causal_padding)
+    return F.conv1d(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
         super().__init__()
@@ -230,6 +265,134 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
+    def _attn_bias(self, mask, dtype):
+        # (B, L, 1) stands in for the hidden states, of which only the length and device are used
+        attn_mask = add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        return mask_to_bias(attn_mask == 1, dtype)
+
+    def _resnets(self):
+        return [blocks[0] for blocks in (*self.down_blocks, *self.mid_blocks, *self.up_blocks)]
+
+    @torch.inference_mode()
+    def prepare(self, mask, mu, t, spks=None, cond=None) -> PreparedConditioning:
+        """
+        Precomputes the step-invariant part of `forward` for an ODE solve, where only `x` and the time change.
+
+        Args:
+            mask, mu, spks, cond: as in `forward`.
+            t (torch.Tensor): every time the decoder will be evaluated at, shape (n_times,).
+
+        Returns:
+            PreparedConditioning: input of `forward_prepared`.
+        """
+        dtype = mu.dtype
+        batch = mu.shape[0]
+
+        cond_x = mu
+        if spks is not None:
+            cond_x = pack([cond_x, repeat(spks, "b c -> b c t", t=mu.shape[-1])], "b * t")[0]
+        if cond is not None:
+            cond_x = pack([cond_x, cond], "b * t")[0]
+
+        # the first convolutions are linear: split them into the x part and the (fixed) conditioning part
+        first = self.down_blocks[0][0]
+        conv1, res_conv = first.block1.block[0], first.res_conv
+        n_x = conv1.in_channels - cond_x.shape[1]
+        conv1_cond = _conv(conv1, cond_x * mask, conv1.weight[:, n_x:], conv1.bias)
+        res_cond = _conv(res_conv, cond_x * mask, res_conv.weight[:, n_x:], res_conv.bias)
+
+        masks = [mask]
+        down_biases = []
+        for _ in self.down_blocks:
+            down_biases.append(self._attn_bias(masks[-1], dtype))
+            masks.append(masks[-1][:, :, ::2])
+        down_masks = masks[:-1]
+        up_masks = down_masks[::-1]
+
+        # all evaluation times at once: (n_times * B,) -> (n_times, B, dim)
+        t_all = t.to(dtype).repeat_interleave(batch)
+        time_emb = self.time_mlp(self.time_embeddings(t_all).to(dtype))
+        resnet_time_emb = [r.mlp(time_emb).view(len(t), batch, -1) for r in self._resnets()]
+
+        return PreparedConditioning(
+            mask=mask,
+            down_masks=down_masks,
+            down_biases=down_biases,
+            mid_mask=down_masks[-1],
+            mid_bias=down_biases[-1],
+            up_masks=up_masks,
+            up_biases=[self._attn_bias(m, dtype) for m in up_masks],
+            cond_x=cond_x,
+            conv1_weight=conv1.weight[:, :n_x].contiguous(),
+            conv1_cond=conv1_cond,
+            res_weight=res_conv.weight[:, :n_x].contiguous(),
+            res_cond=res_cond,
+            time_emb=time_emb.view(len(t), batch, -1),
+            resnet_time_emb=resnet_time_emb,
+        )
+
+    @staticmethod
+    def _resnet(resnet, x, mask, time_emb, h=None, res=None):
+        "`ResnetBlock1D.forward` with a precomputed time projection (and optionally precomputed convolutions)."
+        if h is None:
+            h = resnet.block1(x, mask)
+        h += time_emb.unsqueeze(-1)
+        h = resnet.block2(h, mask)
+        if res is None:
+            res = resnet.res_conv(x * mask)
+        return h + res
+
+    def forward_prepared(self, x, prepared: PreparedConditioning, t_index: int):
+        """
+        Same as `forward`, with the conditioning of `prepare` and the time `t[t_index]` of that call.
+        """
+        p = prepared
+        t = p.time_emb[t_index]
+        resnet_t = iter(e[t_index] for e in p.resnet_time_emb)
+
+        # first block: only the x part of its convolutions is left to compute
+        first = self.down_blocks[0][0]
+        conv1 = first.block1.block[0]
+        x_masked = x * p.mask
+        h = _conv(conv1, x_masked, p.conv1_weight) + p.conv1_cond
+        h = first.block1.block[1:](h) * p.mask
+        res = _conv(first.res_conv, x_masked, p.res_weight) + p.res_cond
+
+        hiddens = []
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = p.down_masks[i]
+            if i == 0:
+                x = self._resnet(resnet, None, mask_down, next(resnet_t), h=h, res=res)
+            else:
+                x = self._resnet(resnet, x, mask_down, next(resnet_t))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x = transformer_block(hidden_states=x, attention_mask=p.down_biases[i], timestep=t)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            hiddens.append(x)  # Save hidden states for skip connections
+            x = downsample(x * mask_down)
+
+        for resnet, transformer_blocks in self.mid_blocks:
+            x = self._resnet(resnet, x, p.mid_mask, next(resnet_t))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x = transformer_block(hidden_states=x, attention_mask=p.mid_bias, timestep=t)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+
+        for i, (resnet, transformer_blocks, upsample) in enumerate(self.up_blocks):
+            mask_up = p.up_masks[i]
+            skip = hiddens.pop()
+            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+            x = self._resnet(resnet, x, mask_up, next(resnet_t))
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x = transformer_block(hidden_states=x, attention_mask=p.up_biases[i], timestep=t)
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            x = upsample(x * mask_up)
+        x = self.final_block(x, mask_up)
+        output = self.final_proj(x * mask_up)
+        return output * p.mask
+
     def forward(self, x, mask, mu, t, spks=None, cond=None):
         """Forward pass of the UNet1DConditional model.
 
@@ -193,6 +193,59 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         # FIXME: this was missing - just putting it in as false
         self.fp16 = False
 
+        # per-voice prompt work, see `get_prompt_cache`
+        self._prompt_cache = {}
+
+    @torch.inference_mode()
+    def get_prompt_cache(self, prompt_token, prompt_token_len, prompt_feat, embedding, max_prompt_tokens=None,
+                         max_entries=8):
+        """
+        Computes the per-voice part of `inference` once: the token embeddings of the reference prompt, its mel
+        features in the model dtype and the normalized, projected x-vector. With `max_prompt_tokens`, only the
+        first `max_prompt_tokens` tokens (and their mel frames) of the reference are used as prompt.
+
+        Entries are keyed by the identity of the reference tensors (e.g. those of the voice conditionals), which
+        they keep alive so that the key cannot be reused by other tensors. No device sync or copy is needed to
+        look them up, but a reference modified in place is not noticed: call `clear_prompt_cache` after that.
+
+        NOTE: the encoder attends over prompt and content together, so its output for the prompt cannot be reused.
+        """
+        dtype = self.spk_embed_affine_layer.weight.dtype
+        if max_prompt_tokens is not None and max_prompt_tokens >= prompt_token.shape[1]:
+            max_prompt_tokens = None
+        sources = (prompt_token, prompt_token_len, prompt_feat, embedding)
+        key = tuple((id(v), v.data_ptr()) for v in sources), max_prompt_tokens, dtype
+        if key in self._prompt_cache:
+            return self._prompt_cache[key]
+
+        if max_prompt_tokens is not None:
+            prompt_token = prompt_token[:, :max_prompt_tokens]
+            prompt_token_len = torch.clamp(prompt_token_len, max=max_prompt_tokens)
+            prompt_feat = prompt_feat[:, :max_prompt_tokens * self.token_mel_ratio]
+
+        # xvec projection
+        spks = F.normalize(embedding.to(dtype), dim=1)
+        spks = self.spk_embed_affine_layer(spks)
+
+        prompt_token_len = prompt_token_len.to(prompt_token.device)
+        mask = (~make_pad_mask(prompt_token_len, prompt_token.shape[1])).unsqueeze(-1).to(dtype)
+        token_emb = self.input_embedding(torch.clamp(prompt_token, min=0)) * mask
+
+        while len(self._prompt_cache) >= max_entries:
+            del self._prompt_cache[next(iter(self._prompt_cache))]
+        prompt = dict(
+            token_emb=token_emb,  # (1, prompt tokens, input_size)
+            token_len=prompt_token_len,
+            feat=prompt_feat.to(dtype),  # (1, prompt frames, output_size)
+            spks=spks,  # (1, output_size)
+            sources=sources,  # keeps the ids of the key valid
+        )
+        self._prompt_cache[key] = prompt
+        return prompt
+
+    def clear_prompt_cache(self):
+        self._prompt_cache.clear()
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -202,21 +255,35 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
-        embedding = embedding.to(self.spk_embed_affine_layer.weight.dtype)
-        prompt_feat = prompt_feat.to(self.spk_embed_affine_layer.weight.dtype)
+                  finalize,
+                  max_prompt_tokens=None,
+                  n_timesteps=10,
+                  solver="euler",
+                  t_scheduler=None):
+        """
+        Mels of the speech tokens `token` (B, T), right-padded to the lengths `token_len` (B,), all in the voice of
+        the (single) prompt. Returns the mels (B, 80, T_mel) and their lengths (B,). The padded frames of shorter
+        items are not meaningful.
 
-        assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        With `finalize=False` (streaming, B=1 only), the last `pre_lookahead_len` tokens are only used as lookahead.
+        """
+        prompt = self.get_prompt_cache(prompt_token, prompt_token_len, prompt_feat, embedding, max_prompt_tokens)
+        prompt_feat, embedding = prompt["feat"], prompt["spks"]
+
+        batch = token.shape[0]
+        assert finalize or batch == 1, "streaming (finalize=False) only supports a batch of one"
+        token_len = token_len.to(token.device)
+        mel_lens2 = token_len * self.token_mel_ratio
+        if finalize is False:
+            mel_lens2 = mel_lens2 - self.pre_lookahead_len * self.token_mel_ratio
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        mask = (~make_pad_mask(token_len, token.shape[1])).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
+        token_emb = prompt["token_emb"].expand(batch, -1, -1)
+        token, token_len = torch.concat([token_emb, token], dim=1), prompt["token_len"] + token_len
 
-        # text encode
+        # text encode (padding is masked out in the conformer attention)
         h, h_lengths = self.encoder(token, token_len)
         if finalize is False:
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
@@ -224,18 +291,21 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
+        conds = torch.zeros([batch, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
         conds[:, :mel_len1] = prompt_feat
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(mel_len1 + mel_lens2, mel_len1 + mel_len2)).to(h)
+        embedding = embedding.expand(batch, -1)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            t_scheduler=t_scheduler,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
-        return feat, None  # NOTE jrm: why are they returning None here?
+        return feat, mel_lens2
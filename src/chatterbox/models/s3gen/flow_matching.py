@@ -27,6 +27,10 @@ CFM_PARAMS = OmegaConf.create({
     "reg_loss_type": "l1"
 })
 
+# ODE solvers of `ConditionalCFM.solve` and their number of estimator calls per step
+SOLVERS = {"euler": 1, "heun": 2, "midpoint": 2, "multistep": 1}
+T_SCHEDULERS = ("linear", "cosine")
+
 
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
@@ -74,11 +78,99 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        t_span = self.get_t_span(n_timesteps, device=mu.device, dtype=mu.dtype)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
+    def get_t_span(self, n_timesteps, t_scheduler=None, device=None, dtype=None):
+        """Time points of the ODE integration, from 0 (noise) to 1 (data)."""
+        t_scheduler = t_scheduler or self.t_scheduler
+        assert t_scheduler in T_SCHEDULERS, f"unknown t_scheduler {t_scheduler}, expected one of {T_SCHEDULERS}"
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+        if t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        return t_span
+
+    def solve(self, x, t_span, mu, mask, spks, cond, solver="euler"):
+        """
+        Integrates the flow from noise `x` along `t_span` with the given solver:
+
+        - euler: first order, one estimator call per step (the reference solver).
+        - heun / midpoint: second order Runge-Kutta, two estimator calls per step.
+        - multistep: second order Adams-Bashforth on the previous velocity (in the spirit of DPM-Solver++ 2M),
+          one estimator call per step.
+        """
+        assert solver in SOLVERS, f"unknown solver {solver}, expected one of {list(SOLVERS)}"
+        if solver == "euler":
+            return self.solve_euler(x, t_span, mu, mask, spks, cond)
+
+        n_steps = len(t_span) - 1
+        # every time the estimator is evaluated at, so that its time embeddings are computed up front
+        if solver == "heun":
+            t_eval = t_span
+        elif solver == "midpoint":
+            t_eval = torch.cat([t_span[:-1], 0.5 * (t_span[:-1] + t_span[1:])])
+        else:
+            t_eval = t_span[:-1]
+        velocity = self._cfg_velocity(x, mu, mask, spks, cond, t_eval)
+
+        prev_v, prev_dt = None, None
+        for step in range(1, n_steps + 1):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            v = velocity(x, t, step - 1)
+            if solver == "heun":
+                v_end = velocity(x + dt * v, t_span[step], step)
+                x = x + dt * 0.5 * (v + v_end)
+            elif solver == "midpoint":
+                x = x + dt * velocity(x + 0.5 * dt * v, t_eval[n_steps + step - 1], n_steps + step - 1)
+            elif prev_v is None:
+                x = x + dt * v
+            else:
+                # variable step size Adams-Bashforth 2
+                r = dt / prev_dt
+                x = x + dt * ((1 + 0.5 * r) * v - 0.5 * r * prev_v)
+            prev_v, prev_dt = v, dt
+        return x.float()
+
+    def _cfg_velocity(self, x, mu, mask, spks, cond, t_eval):
+        """
+        Returns a function (x, t, t_index) -> classifier-free guided velocity at time t = t_eval[t_index].
+
+        The estimator runs the conditional and unconditional rows of all B items as one batch of 2B, whose inputs
+        are allocated once and refilled on every call. A `ConditionalDecoder` estimator also gets its step-invariant
+        work (masks, conditioning, time embeddings of all of `t_eval`) prepared once, so that every call only runs
+        the x-dependent part.
+        """
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        b = x.size(0)
+        x_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * b, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * b], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * b, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * b, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in[:b] = mask
+        mask_in[b:] = mask
+        mu_in[:b] = mu
+        spks_in[:b] = spks
+        cond_in[:b] = cond
+
+        prepared = None
+        if isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, "prepare"):
+            prepared = self.estimator.prepare(mask_in, mu_in, t_eval, spks_in, cond_in)
+
+        def velocity(x, t, t_index):
+            x_in[:b] = x
+            x_in[b:] = x
+            if prepared is not None:
+                dphi_dt = self.estimator.forward_prepared(x_in, prepared, t_index)
+            else:
+                t_in[:] = t
+                dphi_dt = self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in)
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+        return velocity
+
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
         Fixed euler solver for ODEs.
@@ -94,41 +186,17 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        # Classifier-Free Guidance inference introduced in VoiceBox, with the conditioning prepared once
+        velocity = self._cfg_velocity(x, mu, mask, spks, cond, t_span[:-1])
 
         # I am storing this because I can later plot it by putting a debugger here and saving it to a file
         # Or in future might add like a return_all_steps flag
         sol = []
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
+            dt = t_span[step] - t_span[step - 1]
+            x = x + dt * velocity(x, t_span[step - 1], step - 1)
             sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
 
         return sol[-1].float()
 
@@ -137,12 +205,12 @@ class ConditionalCFM(BASECFM):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -201,7 +269,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver="euler", t_scheduler=None):
         """Forward diffusion
 
         Args:
@@ -214,15 +282,17 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str): ODE solver, see `solve`.
+            t_scheduler (str, optional): "linear" or "cosine" time steps. Defaults to the configured scheduler.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
+        # every item of a batch starts from the same noise, as it would on its own
         z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        z = z.expand(mu.size(0), -1, -1)
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        t_span = self.get_t_span(n_timesteps, t_scheduler, device=mu.device, dtype=mu.dtype)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), None
@@ -177,6 +177,11 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        max_prompt_tokens: Optional[int] = None,
+        n_timesteps: int = 10,
+        solver: str = "euler",
+        t_scheduler: Optional[str] = None,
+        speech_token_lens: Optional[torch.LongTensor] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -185,14 +190,17 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - A batch of B > 1 shares the one reference and needs `finalize=True`.
 
         Args
         ----
-        - `speech_tokens`: S3 speech tokens [B=1, T]
+        - `speech_tokens`: S3 speech tokens [B, T], right-padded if their lengths differ
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `max_prompt_tokens`: only use the first `max_prompt_tokens` tokens of the reference as prompt.
+        - `n_timesteps`, `solver`, `t_scheduler`: ODE integration of the CFM decoder, see `ConditionalCFM.solve`.
+        - `speech_token_lens`: lengths of the items of a padded batch [B] (default: all of `speech_tokens`)
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
@@ -209,13 +217,18 @@ class S3Token2Mel(torch.nn.Module):
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
 
-        # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
-        speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
+        if speech_token_lens is None:
+            speech_token_lens = torch.full((speech_tokens.size(0),), speech_tokens.size(1), dtype=torch.long)
+        speech_token_lens = speech_token_lens.to(self.device)
 
         output_mels, _ = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            max_prompt_tokens=max_prompt_tokens,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            t_scheduler=t_scheduler,
             **ref_dict,
         )
         return output_mels
@@ -228,6 +241,14 @@ class S3Token2Wav(S3Token2Mel):
     TODO: make these modules configurable?
     """
 
+    SAMPLES_PER_MEL_FRAME = 480
+    # log-mel value of silence (the clamp of `mel_spectrogram`), used to pad batched mels before vocoding
+    MEL_SILENCE = float(np.log(1e-5))
+
+    # streaming: trailing mel frames re-vocoded with the next chunk, and the matching number of samples
+    STREAM_MEL_CACHE_LEN = 8
+    STREAM_SOURCE_CACHE_LEN = STREAM_MEL_CACHE_LEN * SAMPLES_PER_MEL_FRAME
+
     def __init__(self):
         super().__init__()
 
@@ -247,6 +268,10 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+        # cross-fade window for the overlap between streamed chunks
+        stream_window = torch.from_numpy(np.hamming(2 * self.STREAM_SOURCE_CACHE_LEN)).float()
+        self.register_buffer("stream_window", stream_window, persistent=False)
+
     def forward(
         self,
         speech_tokens,
@@ -280,8 +305,15 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        max_prompt_tokens: Optional[int] = None,
+        n_timesteps: int = 10,
+        solver: str = "euler",
+        t_scheduler: Optional[str] = None,
+        speech_token_lens: Optional[torch.LongTensor] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+                               max_prompt_tokens=max_prompt_tokens, n_timesteps=n_timesteps, solver=solver,
+                               t_scheduler=t_scheduler, speech_token_lens=speech_token_lens)
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -301,8 +333,15 @@ class S3Token2Wav(S3Token2Mel):
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
         no_trim: bool = False,
+        max_prompt_tokens: Optional[int] = None,
+        # ODE integration of the CFM decoder, see `ConditionalCFM.solve`. Fewer steps trade fidelity for speed.
+        n_timesteps: int = 10,
+        solver: str = "euler",
+        t_scheduler: Optional[str] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+                                          max_prompt_tokens=max_prompt_tokens, n_timesteps=n_timesteps, solver=solver,
+                                          t_scheduler=t_scheduler)
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
@@ -310,3 +349,97 @@ class S3Token2Wav(S3Token2Mel):
             output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def batch_inference(
+        self,
+        speech_tokens: list,
+        ref_dict: dict,
+        no_trim: bool = False,
+        max_prompt_tokens: Optional[int] = None,
+        n_timesteps: int = 10,
+        solver: str = "euler",
+        t_scheduler: Optional[str] = None,
+    ):
+        """
+        Token-to-wav synthesis of several utterances of the same voice at once.
+
+        `speech_tokens` is a list of 1D token tensors of any lengths. They are right-padded into one batch, whose
+        padding is masked out in the flow encoder and the CFM decoder. The mel frames past the end of each item are
+        set to silence before vocoding (HiFT has no mask, so the last few frames of the shorter items see silence
+        instead of the zero padding they would get on their own), and every waveform is cut to its own length.
+
+        Returns a list of waveforms (1, T_i), in the order of `speech_tokens`.
+        """
+        token_lens = torch.LongTensor([len(tokens) for tokens in speech_tokens])
+        batch = torch.nn.utils.rnn.pad_sequence([tokens.to(self.device) for tokens in speech_tokens], batch_first=True)
+        output_mels = self.flow_inference(batch, ref_dict=ref_dict, finalize=True, max_prompt_tokens=max_prompt_tokens,
+                                          n_timesteps=n_timesteps, solver=solver, t_scheduler=t_scheduler,
+                                          speech_token_lens=token_lens)
+
+        mel_lens = (token_lens * self.flow.token_mel_ratio).tolist()
+        for i, mel_len in enumerate(mel_lens):
+            output_mels[i, :, mel_len:] = self.MEL_SILENCE
+        output_wavs, _ = self.hift_inference(output_mels)
+
+        wavs = []
+        for i, mel_len in enumerate(mel_lens):
+            wav = output_wavs[i:i + 1, :mel_len * self.SAMPLES_PER_MEL_FRAME].clone()
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            if not no_trim:
+                wav[:, :len(self.trim_fade)] *= self.trim_fade
+            wavs.append(wav)
+        return wavs
+
+    @torch.inference_mode()
+    def stream_inference(
+        self,
+        speech_tokens,
+        token_offset: int,
+        ref_dict: dict,
+        cache: Optional[dict] = None,
+        finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: str = "euler",
+        t_scheduler: Optional[str] = None,
+    ):
+        """
+        One step of streaming token-to-wav synthesis.
+
+        `speech_tokens` holds all the tokens generated so far. The flow runs over all of them, so the encoder
+        sees the full left context, and only the mels from `token_offset` onwards are vocoded. With
+        `finalize=False`, the last `flow.pre_lookahead_len` tokens are only used as lookahead. The last mel
+        frames of a chunk, their source excitation and their audio are kept in `cache`. The next chunk
+        re-vocodes and cross-fades them, which avoids clicks at the boundaries.
+
+        Returns the new audio (B=1, T) and the cache for the next call (None once finalized).
+        """
+        output_mels = self.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=finalize, n_timesteps=n_timesteps,
+                                          solver=solver, t_scheduler=t_scheduler)
+        output_mels = output_mels[:, :, token_offset * self.flow.token_mel_ratio:]
+
+        if cache is None:
+            cache_source = torch.zeros(1, 1, 0).to(self.device)
+        else:
+            output_mels = torch.cat([cache["mel"], output_mels], dim=2)
+            cache_source = cache["source"]
+        output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
+
+        if cache is None:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+        else:
+            n_overlap = len(self.stream_window) // 2
+            output_wavs[:, :n_overlap] = output_wavs[:, :n_overlap] * self.stream_window[:n_overlap] + \
+                cache["speech"] * self.stream_window[n_overlap:]
+
+        if finalize:
+            return output_wavs, None
+
+        n_cache = self.STREAM_SOURCE_CACHE_LEN
+        cache = dict(
+            mel=output_mels[:, :, -self.STREAM_MEL_CACHE_LEN:],
+            source=output_sources[:, :, -n_cache:],
+            speech=output_wavs[:, -n_cache:].clone(),
+        )
+        return output_wavs[:, :-n_cache], cache
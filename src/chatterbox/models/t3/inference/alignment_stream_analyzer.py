@@ -26,19 +26,77 @@ class AlignmentAnalysisResult:
     position: int
 
 
+# Bad endings that `AlignmentStreamAnalyzer` can stop generation on
+STOP_CRITERIA = ("long_tail", "repetition", "complete")
+
+
+class AttentionSpy:
+    """
+    Collects the head-averaged attention weights of one self-attention layer at every forward pass.
+
+    Using `output_attentions=True` is incompatible with optimized attention kernels, so
+    using it for all layers slows things down too much. We can apply it to just one layer
+    by intercepting the kwargs and adding a forward hook (credit: jrm)
+    """
+
+    def __init__(self, tfmr, alignment_layer_idx=9):
+        # (B, T_query, T_key) attention of the last forward pass, and the cache position of its first query
+        self.last_attn = None
+        self.query_start = None
+
+        self.target_layer = tfmr.layers[alignment_layer_idx].self_attn
+        self._hook_handle = self.target_layer.register_forward_hook(self._attention_forward_hook, with_kwargs=True)
+
+        original_forward = self.target_layer.forward
+        def patched_forward(self, *args, **kwargs):
+            kwargs['output_attentions'] = True
+            return original_forward(*args, **kwargs)
+
+        self.target_layer.forward = MethodType(patched_forward, self.target_layer)
+
+    def _attention_forward_hook(self, module, args, kwargs, output):
+        """
+        See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+        NOTE:
+        - When `output_attentions=True`, `LlamaSdpaAttention.forward` also computes the attention weights.
+        - `attn_weights` has shape [B, H, T0, K] for the prefill, and [B, H, 1, K] for every next step.
+        """
+        self.last_attn = output[1].float().mean(1)  # (B, T, K)
+        self.query_start = kwargs.get("cache_position")
+
+    def remove(self):
+        """Unhooks and unpatches the layer."""
+        self._hook_handle.remove()
+        del self.target_layer.forward  # back to the class method
+
+
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0, row=0, spy=None,
+                 stop_on=("long_tail", "repetition"), complete_tail=25, suppress_early_eos=True):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
         A hook is injected into the specified attention layer, and heuristics are used to determine alignment
         position, repetition, etc.
 
+        `row` is the batch row this analyzer follows, and `text_tokens_slice` its text positions. Several analyzers
+        can share one `AttentionSpy` (one hook for the whole batch). EOS is forced on the bad endings in `stop_on`
+        (see `STOP_CRITERIA`); "complete" stops `complete_tail` frames after the alignment reached the end of the
+        text. With `suppress_early_eos`, EOS is prevented before the alignment gets near the end of the text.
+
         NOTE: currently requires no queues.
         """
         # self.queue = queue
+        assert all(c in STOP_CRITERIA for c in stop_on), f"unknown stop criteria {stop_on}, see {STOP_CRITERIA}"
         self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
+        self.row = row
+        self.stop_on = tuple(stop_on)
+        self.complete_tail = complete_tail
+        self.suppress_early_eos = suppress_early_eos
+        # why EOS was forced (one of STOP_CRITERIA) and at which frame, None while generation runs freely
+        self.stop_reason = None
+        self.stopped_at = None
         self.alignment = torch.zeros(0, j-i)
         # self.alignment_bin = torch.zeros(0, j-i)
         self.curr_frame_pos = 0
@@ -50,52 +108,19 @@ class AlignmentStreamAnalyzer:
         self.complete = False
         self.completed_at = None
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attn = None
-        self._add_attention_spy(tfmr, alignment_layer_idx)
-
-    def _add_attention_spy(self, tfmr, alignment_layer_idx):
-        """
-        Adds a forward hook to a specific attention layer to collect outputs.
-        Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        using it for all layers slows things down too much.
-        (credit: jrm)
-        """
-
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
-
-        target_layer = tfmr.layers[alignment_layer_idx].self_attn
-        hook_handle = target_layer.register_forward_hook(attention_forward_hook)
-
-        # Backup original forward
-        original_forward = target_layer.forward
-        def patched_forward(self, *args, **kwargs):
-            kwargs['output_attentions'] = True
-            return original_forward(*args, **kwargs)
-
-        # TODO: how to unpatch it?
-        target_layer.forward = MethodType(patched_forward, target_layer)
+        self.spy = spy if spy is not None else AttentionSpy(tfmr, alignment_layer_idx)
 
     def step(self, logits):
         """
         Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = self.last_aligned_attn # (N, N)
+        aligned_attn = self.spy.last_attn[self.row] # (T_query, K)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
-            # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            # first chunk has conditioning info (unless it came from a prefilled prefix), text tokens, and BOS token
+            query_start = int(self.spy.query_start[0]) if self.spy.query_start is not None else 0
+            A_chunk = aligned_attn[j - query_start:, i:j].clone().cpu() # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
             A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
@@ -138,16 +163,23 @@ class AlignmentStreamAnalyzer:
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
         repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
 
+        # Generation went on well past the end of the text
+        complete_tail = self.complete and (T - self.completed_at >= self.complete_tail)
+
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or repetition:
-            logger.warn(f"forcing EOS token, {long_tail=}, {repetition=}")
+        detected = dict(long_tail=long_tail, repetition=repetition, complete=complete_tail)
+        reason = next((c for c in self.stop_on if detected[c]), None)
+        if reason is not None:
+            if self.stop_reason is None:
+                logger.info(f"forcing EOS token at frame {T}: {reason}")
+                self.stop_reason, self.stopped_at = reason, T
             # (±2**15 is safe for all dtypes >= 16bit)
             logits = -(2**15) * torch.ones_like(logits)
             logits[..., self.eos_idx] = 2**15
 
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3: # FIXME: arbitrary
+        elif self.suppress_early_eos and cur_text_posn < S - 3: # FIXME: arbitrary
             logits[..., self.eos_idx] = -2**15
 
         self.curr_frame_pos += 1
@@ -0,0 +1,119 @@
+import time
+from collections import deque
+
+import torch
+from torch import Tensor
+
+
+class FinishedFlag:
+    """
+    Host view of the device-resident "every row emitted EOS" flag of the decode loop, read without stalling the
+    device.
+
+    On CUDA, every `update` copies the flag into a ring of pinned host slots and records an event. `done` only
+    reads the slots whose copy has landed, so the loop notices EOS a step or two late instead of waiting for the
+    device at every step (the extra tokens are trimmed afterwards). The host blocks only if it gets a whole ring
+    ahead of the device. On other devices, the flag is read directly every `interval` steps.
+    """
+
+    def __init__(self, device, slots: int = 8, interval: int = 8):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.interval = 1 if self.device.type == "cpu" else interval
+        self.step = 0
+        self.flag = None
+        self.seen = False
+        if self.cuda:
+            self.host = torch.zeros(slots, dtype=torch.bool, pin_memory=True)
+            self.events = [torch.cuda.Event() for _ in range(slots)]
+            self.in_flight = deque()
+
+    def update(self, finished: Tensor):
+        "Publishes the (N,) `finished` rows of this step."
+        self.step += 1
+        if not self.cuda:
+            self.flag = finished
+            return
+        if len(self.in_flight) == len(self.events):
+            oldest = self.in_flight.popleft()
+            self.events[oldest].synchronize()
+            self.seen |= bool(self.host[oldest])
+        slot = self.step % len(self.events)
+        self.host[slot].copy_(finished.all(), non_blocking=True)
+        self.events[slot].record()
+        self.in_flight.append(slot)
+
+    def done(self) -> bool:
+        "Whether all rows were finished at a step the host has heard of."
+        if not self.cuda:
+            return self.flag is not None and self.step % self.interval == 0 and bool(self.flag.all())
+        while self.in_flight and self.events[self.in_flight[0]].query():
+            self.seen |= bool(self.host[self.in_flight.popleft()])
+        return self.seen
+
+
+class StepTimer:
+    """
+    Per-step timings of the decode loop: wall time of each step and the part of it spent in the transformer
+    forward. Everything else (sampling, logits processing, Python overhead, host syncs) is overhead.
+
+    On CUDA the times are taken with events on the device timeline, so timing does not add syncs to the loop.
+    """
+
+    # upper bounds of the histogram buckets, in ms
+    BUCKETS_MS = (1, 2, 4, 8, 16, 32, 64, 128, float("inf"))
+
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == "cuda"
+        self.marks = []  # (step start, forward start, forward end) per step
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _ms(self, start, end) -> float:
+        if self.cuda:
+            return start.elapsed_time(end)
+        return (end - start) * 1000
+
+    def step_start(self):
+        self.marks.append([self._now(), None, None])
+
+    def forward_start(self):
+        self.marks[-1][1] = self._now()
+
+    def forward_end(self):
+        self.marks[-1][2] = self._now()
+
+    def summary(self) -> dict:
+        """
+        Total and forward time, the overhead fraction, percentiles of the step time and its histogram
+        ({"<=1ms": count, ...}). A step lasts until the start of the next one; the last one until its forward ends.
+        """
+        if self.cuda:
+            torch.cuda.synchronize()
+        marks = [m for m in self.marks if m[2] is not None]
+        if not marks:
+            return dict(steps=0)
+        step_ms = [self._ms(m[0], n[0]) for m, n in zip(marks, marks[1:])] + [self._ms(marks[-1][0], marks[-1][2])]
+        forward_ms = [self._ms(m[1], m[2]) for m in marks]
+        total = sum(step_ms)
+        ordered = sorted(step_ms)
+        histogram, lower = {}, float("-inf")
+        for upper in self.BUCKETS_MS:
+            label = f"<={upper:g}ms" if upper != float("inf") else f">{lower:g}ms"
+            histogram[label] = sum(lower < t <= upper for t in step_ms)
+            lower = upper
+        return dict(
+            steps=len(step_ms),
+            total_ms=total,
+            forward_ms=sum(forward_ms),
+            overhead_fraction=1 - sum(forward_ms) / total if total > 0 else 0.0,
+            p50_ms=ordered[len(ordered) // 2],
+            p90_ms=ordered[int(len(ordered) * 0.9)],
+            p99_ms=ordered[int(len(ordered) * 0.99)],
+            histogram=histogram,
+        )
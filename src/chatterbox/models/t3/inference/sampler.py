@@ -0,0 +1,139 @@
+import hashlib
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+
+def chunk_seed(seed: int, text: str) -> int:
+    "Seed of the sampler stream of one chunk, so that its tokens do not depend on the rest of the batch."
+    return int.from_bytes(hashlib.sha1(f"{seed}:{text}".encode()).digest()[:8], "little") >> 1
+
+
+class SpeechTokenSampler:
+    """
+    Temperature, repetition penalty and top-p sampling of the T3 decode loop, done in place in workspaces that are
+    allocated once and reused for every step and every call of the same batch size.
+
+    Compared with `RepetitionPenaltyLogitsProcessor` + `TopPLogitsWarper` + softmax + `torch.multinomial`:
+        * the repetition penalty is kept as per-token factor tables, updated with each sampled token, instead of
+          being gathered and scattered over the whole padded token history (PAD included) at every step
+        * the nucleus is cut from the `top_k` most likely tokens (with their probabilities over the full
+          vocabulary) instead of a full sort of the vocabulary. If those hold less than `top_p`, the nucleus is
+          the `top_k` tokens.
+        * every row samples from its own seeded uniform stream (inverse CDF), so a chunk gets the same tokens
+          whatever else is in the batch
+    """
+
+    def __init__(self, n_rows: int, vocab_size: int, device, top_k: int = 256, block_size: int = 256):
+        """
+        Args:
+            n_rows: Number of rows sampled at once (the conditional rows of the batch).
+            vocab_size: Size of the speech token vocabulary.
+            device: Device of the logits.
+            top_k: Number of candidates of the nucleus.
+            block_size: Number of uniforms drawn at once per row.
+        """
+        self.n_rows = n_rows
+        self.vocab_size = vocab_size
+        self.device = torch.device(device)
+        self.top_k = min(top_k, vocab_size)
+        self.block_size = block_size
+
+        full = dict(size=(n_rows, vocab_size), device=self.device)
+        top = dict(size=(n_rows, self.top_k), device=self.device)
+        self.logits = torch.empty(**full, dtype=torch.float32)
+        self.penalized = torch.empty(**full, dtype=torch.float32)
+        self.negative = torch.empty(**full, dtype=torch.bool)
+        # logits are multiplied by penalty_pos where positive and by penalty_neg where negative
+        self.penalty_pos = torch.ones(**full, dtype=torch.float32)
+        self.penalty_neg = torch.ones(**full, dtype=torch.float32)
+        self.top_logits = torch.empty(**top, dtype=torch.float32)
+        self.top_ids = torch.empty(**top, dtype=torch.long)
+        self.probs = torch.empty(**top, dtype=torch.float32)
+        self.cum_probs = torch.empty(**top, dtype=torch.float32)
+        self.cut = torch.empty(**top, dtype=torch.bool)
+        self.log_norm = torch.empty(n_rows, 1, device=self.device, dtype=torch.float32)
+        self.target = torch.empty(n_rows, 1, device=self.device, dtype=torch.float32)
+        self.choice = torch.empty(n_rows, 1, device=self.device, dtype=torch.long)
+        self.tokens = torch.empty(n_rows, 1, device=self.device, dtype=torch.long)
+        self.uniform = torch.empty(n_rows, block_size, device=self.device, dtype=torch.float32)
+        self.generators = [torch.Generator(device=self.device) for _ in range(n_rows)]
+
+        self.reset()
+
+    def reset(
+        self,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0,
+        seeds: Optional[list[int]] = None,
+        history: Optional[Tensor] = None,
+    ):
+        """
+        Starts a new decode.
+
+        Args:
+            seeds: One seed per row. If None, they are drawn from the global torch RNG (so `torch.manual_seed`
+                still makes the whole batch reproducible).
+            history: (n_rows, t) tokens already in the sequences (e.g. BOS), penalized like the sampled ones.
+        """
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        if seeds is None:
+            seeds = torch.randint(0, 2 ** 62, (self.n_rows,)).tolist()
+        assert len(seeds) == self.n_rows, f"expected {self.n_rows} seeds, got {len(seeds)}"
+        for generator, seed in zip(self.generators, seeds):
+            generator.manual_seed(seed)
+        self.step = 0
+        self.penalty_pos.fill_(1.0)
+        self.penalty_neg.fill_(1.0)
+        if history is not None:
+            self.observe(history)
+
+    def observe(self, tokens: Tensor):
+        "Adds the (n_rows, t) `tokens` to the penalized ones."
+        if self.repetition_penalty != 1.0:
+            self.penalty_pos.scatter_(1, tokens, 1.0 / self.repetition_penalty)
+            self.penalty_neg.scatter_(1, tokens, self.repetition_penalty)
+
+    def __call__(self, logits: Tensor) -> Tensor:
+        """
+        Samples the next token of every row from (n_rows, vocab_size) logits, and penalizes it from then on.
+
+        Returns an (n_rows, 1) workspace tensor, overwritten by the next call.
+        """
+        logits = self.logits.copy_(logits)
+        if self.temperature != 1.0:
+            logits.mul_(1.0 / self.temperature)
+        if self.repetition_penalty != 1.0:
+            torch.lt(logits, 0, out=self.negative)
+            torch.mul(logits, self.penalty_neg, out=self.penalized)
+            logits.mul_(self.penalty_pos)
+            logits = torch.where(self.negative, self.penalized, logits, out=self.penalized)
+
+        # candidates and their probabilities over the whole vocabulary
+        torch.topk(logits, self.top_k, dim=-1, out=(self.top_logits, self.top_ids))
+        torch.logsumexp(logits, dim=-1, keepdim=True, out=self.log_norm)
+        probs = torch.sub(self.top_logits, self.log_norm, out=self.probs).exp_()
+
+        # nucleus, as `TopPLogitsWarper`: a token is dropped once the tokens before it hold `top_p`
+        if self.top_p < 1.0:
+            torch.cumsum(probs, dim=-1, out=self.cum_probs)
+            torch.ge(self.cum_probs.sub_(probs), self.top_p, out=self.cut)
+            probs.masked_fill_(self.cut, 0.0)
+
+        # inverse CDF of each row's next uniform
+        i = self.step % self.block_size
+        if i == 0:
+            for row, generator in enumerate(self.generators):
+                torch.rand(self.block_size, generator=generator, device=self.device, out=self.uniform[row])
+        torch.cumsum(probs, dim=-1, out=self.cum_probs)
+        torch.mul(self.uniform[:, i:i + 1], self.cum_probs[:, -1:], out=self.target)
+        torch.searchsorted(self.cum_probs, self.target, right=True, out=self.choice)
+        torch.gather(self.top_ids, 1, self.choice.clamp_(max=self.top_k - 1), out=self.tokens)
+
+        self.step += 1
+        self.observe(self.tokens)
+        return self.tokens
@@ -77,6 +77,9 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         use_cache=True,
         output_attentions=False,
         cache_position=None,
+        attention_mask=None,
+        position_ids=None,
+        num_layers=None,
     ):
         """
         This is a method used by huggingface's generate() method.
@@ -84,17 +87,23 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
         S should be 1.
+        :param attention_mask: optional (B, max_cache_len) mask of valid cache positions, for batches of padded rows.
+        :param position_ids: optional (B, S) positions, for batches of padded rows.
+        :param num_layers: optional number of decoder layers to run (early exit), e.g. for a speculative draft.
         """
         # Handle input validation before calling the model
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
             past_key_values=past_key_values,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=False,
             return_dict=False,
             cache_position=cache_position,
+            num_layers=num_layers,
         )
         # Top-level sompilation may require .clone() here
         hidden_states = tfmr_out[0]
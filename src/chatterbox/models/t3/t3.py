@@ -1,6 +1,8 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
+import time
+from functools import partial
 from typing import Union, Optional, List
 
 from tqdm import tqdm
@@ -18,7 +20,9 @@ from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
-from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer, AttentionSpy
+from .inference.sampler import SpeechTokenSampler
+from .inference.decode_monitor import FinishedFlag, StepTimer
 
 
 logger = logging.getLogger(__name__)
@@ -46,6 +50,13 @@ class T3(nn.Module):
             different PE embedding space for speech.
     """
 
+    # self-attention layer whose maps align speech frames to text tokens, see `AlignmentStreamAnalyzer`
+    ALIGNMENT_LAYER_IDX = 9
+    # speculative decoding drafts, see `inference_stream(speculative=...)`: the early-exit depth of "layers", and the
+    # longest suffix that "ngram" looks up in the tokens generated so far
+    DRAFT_LAYERS = 8
+    DRAFT_NGRAM = 4
+
     def __init__(self, hp=T3Config()):
         super().__init__()
         self.hp = hp
@@ -72,6 +83,20 @@ class T3(nn.Module):
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
         self.compiled = False
 
+        # prefilled conditioning prefixes, see `get_cond_prefix`
+        self._cond_prefix_cache = {}
+
+        # alignment-based stopping (see `inference_stream`): the outcome for every row of the last call, and totals
+        self.last_alignment_stats = []
+        self.alignment_counters = dict(chunks=0, long_tail=0, repetition=0, complete=0, tokens_saved=0)
+
+        # speculative decoding: acceptance and speed of the last call, and totals
+        self.last_speculative_stats = None
+        self.speculative_counters = dict(rounds=0, drafted=0, accepted=0, tokens=0, seconds=0.0)
+
+        # per-step timings of the last decode with `inference_stream(step_timing=True)`, see `StepTimer.summary`
+        self.last_step_stats = None
+
     @property
     def device(self):
         return self.speech_head.weight.device
@@ -92,12 +117,14 @@ class T3(nn.Module):
         text_tokens: torch.LongTensor,
         speech_tokens: torch.LongTensor,
         cfg_weight: float = 0.0,
+        cond_emb: Optional[Tensor] = None,
     ):
         # prepare input embeddings (skip backbone tranformer embeddings)
-        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        if cond_emb is None:
+            cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0:
-            text_emb[1].zero_()  # CFG uncond
+            text_emb[text_emb.size(0) // 2:].zero_()  # CFG uncond (second half of the batch)
 
         speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
         if self.hp.input_pos_emb == "learned":
@@ -212,33 +239,36 @@ class T3(nn.Module):
         # TODO? synchronize the expensive compile function
         # with self.compile_lock:
         if not self.compiled:
-            # alignment_stream_analyzer = AlignmentStreamAnalyzer(
-            #     self.tfmr,
-            #     None,
-            #     text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-            #     alignment_layer_idx=9, # TODO: hparam or something?
-            #     eos_idx=self.hp.stop_speech_token,
-            # )
+            # the alignment analyzers are per inference call, see `inference_stream(alignment_stop=...)`
             patched_model = T3HuggingfaceBackend(
                 config=self.cfg,
                 llama=self.tfmr,
                 speech_enc=self.speech_emb,
                 speech_head=self.speech_head,
-                # alignment_stream_analyzer=alignment_stream_analyzer,
             )
             self.patched_model = patched_model
             self.compiled = True
 
-    def get_cache(self, config, max_batch_size, max_cache_len, device, dtype):
-        if hasattr(self, 'backend_cache'):
-            if self.backend_cache_params['max_batch_size'] == max_batch_size and \
-                self.backend_cache_params['max_cache_len'] == max_cache_len and \
-                self.backend_cache_params['dtype'] == dtype and \
-                self.backend_cache_params['device'] == device:
-                self.backend_cache.reset()
-                return self.backend_cache
-            else:
-                del self.backend_cache
+    def get_cache(self, config, max_batch_size, max_cache_len, device, dtype, slot="main"):
+        """
+        Returns the reset `StaticCache` of `slot` if it still has the requested shape, or a new one. Separate slots
+        let one call hold several caches (e.g. the conditional and unconditional rows of a CFG schedule).
+        """
+        if not hasattr(self, 'backend_caches'):
+            self.backend_caches = {}
+        # save parameters in t3 since huggingface fails deprecation standards.
+        params = {
+            'max_batch_size': max_batch_size,
+            'max_cache_len': max_cache_len,
+            'device': device,
+            'dtype': dtype,
+        }
+        if slot in self.backend_caches:
+            cache, cache_params = self.backend_caches[slot]
+            if cache_params == params:
+                cache.reset()
+                return cache
+            del self.backend_caches[slot]
 
         cache = StaticCache(
             config=config,
@@ -247,16 +277,76 @@ class T3(nn.Module):
             device=device,
             dtype=dtype,
         )
-        # save parameters in t3 since huggingface fails deprecation standards.
-        self.backend_cache_params = {
-            'max_batch_size': max_batch_size,
-            'max_cache_len': max_cache_len,
-            'device': device,
-            'dtype': dtype,
-        }
-        self.backend_cache = cache
+        self.backend_caches[slot] = (cache, params)
         return cache
 
+    def get_sampler(self, n_rows, device, top_k=256):
+        "The `SpeechTokenSampler` of a batch of `n_rows`, whose workspaces are kept for the next calls."
+        vocab_size = self.hp.speech_tokens_dict_size
+        sampler = getattr(self, '_sampler', None)
+        if sampler is None or (sampler.n_rows, sampler.vocab_size, sampler.device, sampler.top_k) != \
+                (n_rows, vocab_size, torch.device(device), min(top_k, vocab_size)):
+            sampler = self._sampler = SpeechTokenSampler(n_rows, vocab_size, device, top_k=top_k)
+        return sampler
+
+    @staticmethod
+    def _cond_prefix_key(t3_cond: T3Cond, dtype):
+        """
+        Key of the voice / exaggeration inputs of the conditioning prefix: the identity of their tensors, as in
+        `CausalMaskedDiffWithXvec.get_prompt_cache`, so that a lookup needs no device sync. Returns the key and
+        the tensors, which the cache entry keeps alive so that their ids are not reused.
+        """
+        sources = (t3_cond.speaker_emb, t3_cond.cond_prompt_speech_tokens, t3_cond.emotion_adv)
+        key = tuple((id(v), v.data_ptr()) if torch.is_tensor(v) else repr(v) for v in sources)
+        return (key, dtype), sources
+
+    def get_cond_prefix(self, t3_cond: T3Cond, max_entries: int = 8):
+        """
+        Prefills the conditioning prefix (speaker embedding, perceiver-resampled prompt and emotion token) once per
+        (voice, exaggeration, dtype) and keeps its per-layer key / value rows, so they can be copied into the
+        `StaticCache` of every chunk instead of being recomputed. Entries are keyed by the identity of the `T3Cond`
+        tensors, so conditionals modified in place need a `clear_cond_prefix_cache`.
+
+        Returns None if the conditioning is batched (one prefix per row is not supported).
+        """
+        self.init_patched_model()
+        dtype = self.patched_model.dtype
+        key, sources = self._cond_prefix_key(t3_cond, dtype)
+        if key in self._cond_prefix_cache:
+            return self._cond_prefix_cache[key]
+
+        cond_emb = self.prepare_conditioning(t3_cond).to(dtype)  # (1, len_cond, dim)
+        if cond_emb.size(0) != 1:
+            return None
+        len_cond = cond_emb.size(1)
+        cache = StaticCache(
+            config=self.patched_model.config,
+            max_batch_size=1,
+            max_cache_len=len_cond,
+            device=self.patched_model.device,
+            dtype=dtype,
+        )
+        self.patched_model(
+            inputs_embeds=cond_emb,
+            past_key_values=cache,
+            cache_position=torch.arange(len_cond, device=cond_emb.device),
+        )
+
+        while len(self._cond_prefix_cache) >= max_entries:
+            del self._cond_prefix_cache[next(iter(self._cond_prefix_cache))]
+        prefix = AttrDict(
+            cond_emb=cond_emb,
+            len_cond=len_cond,
+            keys=cache.key_cache,  # (1, n_kv_heads, len_cond, head_dim) per layer
+            values=cache.value_cache,
+            sources=sources,  # keeps the ids of the key valid
+        )
+        self._cond_prefix_cache[key] = prefix
+        return prefix
+
+    def clear_cond_prefix_cache(self):
+        self._cond_prefix_cache.clear()
+
     def get_speech_pos_embedding_cache(self, max_gen_tokens, dtype):
         if not hasattr(self, '_speech_pos_embedding_cache') or self._speech_pos_embedding_cache.size(0) < max_gen_tokens:
             # Create cache with embeddings for positions 0 to max_gen_tokens-1
@@ -284,12 +374,38 @@ class T3(nn.Module):
             self._speech_embedding_cache = self._speech_embedding_cache.to(dtype=dtype)
         return self._speech_embedding_cache
 
+    def _pad_after_cond(self, embeds: Tensor, len_cond: int, text_token_lens: Tensor):
+        """
+        Moves the right-padding of each text row to sit between the conditioning prefix and the text, so that all
+        rows share the conditioning positions and end on their own BOS token.
+
+        Returns the re-arranged embeds, the per-row pad length and a (B, seq_len) mask of valid positions.
+        """
+        B, seq_len, dim = embeds.shape
+        pad = (text_token_lens.max() - text_token_lens).to(device=embeds.device, dtype=torch.long)  # (B,)
+        idx = torch.arange(seq_len, device=embeds.device)[None].expand(B, -1)
+        pad_end = len_cond + pad[:, None]
+        src = torch.where(idx >= pad_end, idx - pad[:, None], idx)
+        embeds = torch.gather(embeds, 1, src[..., None].expand(-1, -1, dim))
+        is_pad = (idx >= len_cond) & (idx < pad_end)
+        embeds = embeds.masked_fill(is_pad[..., None], 0)
+        return embeds, pad, ~is_pad
+
     @torch.inference_mode()
-    def inference(
+    def inference(self, **kwargs):
+        """
+        Decodes the whole utterance and returns the (N, T) speech tokens. See `inference_stream` for the arguments.
+        """
+        kwargs["tokens_per_slice"] = None
+        return torch.cat(list(self.inference_stream(**kwargs)), dim=1)
+
+    @torch.inference_mode()
+    def inference_stream(
         self,
         *,
         t3_cond: T3Cond,
         text_tokens: Tensor,
+        text_token_lens: Optional[Tensor]=None,
         initial_speech_tokens: Optional[Tensor]=None,
 
         # misc conditioning
@@ -306,60 +422,87 @@ class T3(nn.Module):
         repetition_penalty=2.0,
         cfg_weight=0,
         max_cache_len=None,
+        cache_cond_prefix=False,
+        tokens_per_slice=None,
+        alignment_stop=None,
+        cfg_steps=None,
+        cfg_interval=1,
+        speculative=None,
+        draft_tokens=4,
+        seeds=None,
+        step_timing=False,
     ):
         """
         Args:
-            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor. Rows are right-padded, each wrapped in its own
+                start / stop text tokens. With CFG, the second half of the batch is the unconditional copy of the first.
+            text_token_lens: (B,) lengths of the rows of `text_tokens` (including start / stop tokens). Required
+                when the rows have different lengths.
+            cache_cond_prefix: reuse the prefilled key / values of the conditioning prefix (see `get_cond_prefix`),
+                so that the prefill only runs over the text tokens.
+            tokens_per_slice: if set, yield the new tokens every `tokens_per_slice` steps instead of once at the end.
+                EOS is then also checked at every slice, so the stream stops as soon as all rows are done.
+            alignment_stop: force EOS on the bad endings that `AlignmentStreamAnalyzer` detects in the text-speech
+                alignment of layer `ALIGNMENT_LAYER_IDX`: True for ("long_tail", "repetition"), or any of
+                `alignment_stream_analyzer.STOP_CRITERIA`. The decode steps then run uncompiled, and EOS is checked
+                at every step. Outcomes are in `last_alignment_stats` and `alignment_counters`.
+            cfg_steps: CFG schedule: only guide the first `cfg_steps` tokens. The unconditional rows are then
+                dropped, and the rest is decoded at half the batch size.
+            cfg_interval: CFG schedule: refresh the unconditional logits only every `cfg_interval` steps, and
+                reuse the last ones in between. The unconditional rows catch up on the skipped tokens in one
+                forward pass.
+            speculative: decode a single text speculatively: a cheap draft proposes up to `draft_tokens` tokens,
+                which the full model checks in one forward pass. "layers" drafts with the first `DRAFT_LAYERS`
+                decoder layers, "ngram" with the continuation of the latest earlier occurrence of the last tokens.
+                The output follows the same sampling distribution. Acceptance and speed are in
+                `last_speculative_stats` and `speculative_counters`.
+            seeds: one sampler seed per conditional row, so that each row gets the same tokens in any batch (see
+                `SpeechTokenSampler`). By default they are drawn from the global torch RNG. Not used by
+                speculative decoding, which samples from the full distributions.
+            step_timing: time every decode step and its transformer forward, and keep the summary (overhead
+                fraction, percentiles, histogram) in `last_step_stats`.
+
+        Yields:
+            (N, t) slices of speech tokens, one row per (conditional) input sequence. Rows that hit EOS before the
+            others are filled with `stop_speech_token` from that point on.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        batch_size = text_tokens.size(0)
+        if cfg_weight > 0.0:
+            assert batch_size % 2 == 0, "CFG expects the conditional rows followed by their unconditional copies"
+        n_rows = batch_size // 2 if cfg_weight > 0.0 else batch_size
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
             initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
+        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
+        # Note the llama-specific logic. Other tfmr types can be added later.
+        self.init_patched_model()
+
+        prefix = self.get_cond_prefix(t3_cond) if cache_cond_prefix else None
+
         # Prepare custom input embeds
         embeds, len_cond = self.prepare_input_embeds(
             t3_cond=t3_cond,
             text_tokens=text_tokens,
             speech_tokens=initial_speech_tokens,
             cfg_weight=cfg_weight,
+            cond_emb=None if prefix is None else prefix.cond_emb,
         )
-
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
-        self.init_patched_model()
         # Pre-compute embeddings cache for the generation loop
         self.get_speech_pos_embedding_cache(max_new_tokens + 1 or self.hp.max_speech_tokens, dtype=embeds.dtype)
         self.init_speech_embedding_cache(vocab_size=self.hp.speech_tokens_dict_size, dtype=embeds.dtype)
 
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     top_p=top_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
         device = embeds.device
 
         bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
         bos_embed = self._speech_embedding_cache[bos_token]
         bos_embed = bos_embed + self._speech_pos_embedding_cache[0]
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
+        bos_embed = bos_embed.expand(batch_size, -1, -1)
 
         # Combine condition and BOS token for the initial input if cfg_weight > 0
         if cfg_weight > 0:
@@ -367,119 +510,442 @@ class T3(nn.Module):
         else:
             inputs_embeds = embeds
 
+        # Rows of different text lengths: pad between the conditioning and the text, mask the padding out of
+        # attention and shift the positions so that every row sees the same positions as it would unbatched.
+        pad = None
+        if text_token_lens is not None:
+            text_token_lens = text_token_lens.to(device=device)
+            if bool((text_token_lens != text_tokens.size(1)).any()):
+                inputs_embeds, pad, valid = self._pad_after_cond(inputs_embeds, len_cond, text_token_lens)
+
         # Track generated token ids; start with the BOS token.
         PAD_TOKEN_ID = self.hp.stop_speech_token + 1 # Assuming unused
         bos_len = bos_token.shape[1]
-        # using batch size of 1, otherwise use generated_ids[:, i] 
-        generated_ids = torch.full((1, bos_len + max_new_tokens), PAD_TOKEN_ID, dtype=torch.long, device=device)
-        generated_ids[0, :bos_len] = bos_token
-
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
+        generated_ids = torch.full((n_rows, bos_len + max_new_tokens), PAD_TOKEN_ID, dtype=torch.long, device=device)
+        generated_ids[:, :bos_len] = bos_token
+
+        # The decode loop samples with a fused sampler, speculative decoding with the logits processors.
+        sampler = self.get_sampler(n_rows, device)
+        sampler.reset(
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            seeds=seeds,
+            history=generated_ids[:, :bos_len],
+        )
         top_p_warper = TopPLogitsWarper(top_p=top_p)
         repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)
 
         # move all inputs to patched_model.dtype
         inputs_embeds = inputs_embeds.to(self.patched_model.dtype)
-        embeds = embeds.to(self.patched_model.dtype)
-        bos_embed = bos_embed.to(self.patched_model.dtype)
 
         stop_token_tensor = torch.tensor(self.hp.stop_speech_token, device=self.device)
-        
-        # Fix: Set max_batch_size based on CFG usage
-        effective_batch_size = 2 if cfg_weight > 0.0 else 1
 
         _, seq_len = inputs_embeds.shape[:2]
         assert max_cache_len > seq_len + max_new_tokens, \
             f"max_cache_len {max_cache_len} is too small for seq_len {seq_len} and max_new_tokens {max_new_tokens}"
 
+        # With a CFG schedule, the conditional and unconditional rows live in separate caches, so that the
+        # unconditional ones can skip steps and be dropped once guidance ends.
+        split_cfg = cfg_weight > 0.0 and (cfg_steps is not None or cfg_interval > 1)
         kv_cache = self.get_cache(
             config=self.patched_model.config,
-            max_batch_size=effective_batch_size,
+            max_batch_size=n_rows if split_cfg else batch_size,
             max_cache_len=max_cache_len,
             device=self.patched_model.device,
             dtype=self.patched_model.dtype,
         )
+        caches = [kv_cache]
+        if split_cfg:
+            uncond_cache = self.get_cache(
+                config=self.patched_model.config,
+                max_batch_size=n_rows,
+                max_cache_len=max_cache_len,
+                device=self.patched_model.device,
+                dtype=self.patched_model.dtype,
+                slot="uncond",
+            )
+            caches.append(uncond_cache)
+
+        if speculative is not None:
+            assert speculative in ("layers", "ngram"), f"unknown speculative draft {speculative!r}"
+            assert n_rows == 1 and not split_cfg and not alignment_stop, \
+                "speculative decoding takes a single text, without CFG schedule or alignment stop"
 
         # Move check higher to avoid polluting the loop
         assert not kv_cache.get_seq_length() > 0, \
             "Cannot process large input when cache already has content"
 
-        length_guesstimate = text_tokens.shape[1] * 2
-        # print(f"Estimated token count: {length_guesstimate}")
-        length_guesstimate = int(length_guesstimate * 0.8) # variance
-
         cache_position = torch.arange(seq_len, device=inputs_embeds.device)
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output_logits = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=kv_cache,
-            cache_position=cache_position,
-        )
-
-        # ---- Generation Loop using kv_cache ----
-        # for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-        for i in range(max_new_tokens):
-            logits = output_logits[:, -1, :]
-
-            # CFG
-            if cfg_weight > 0.0:
-                logits_cond = logits[0:1]
-                logits_uncond = logits[1:2]
-                logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
-
-            logits = logits.squeeze(1)
-
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = top_p_warper(None, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids[0, i + bos_len] = next_token
-
-            # if i % tokens_per_slice == 0:
-            #     yield torch.cat(predicted, dim=1)
+        attention_mask = position_ids = None
+        if pad is not None:
+            attention_mask = torch.ones(batch_size, max_cache_len, dtype=torch.long, device=device)
+            attention_mask[:, :seq_len] = valid.long()
+            position_ids = cache_position[None] - pad[:, None] * (cache_position[None] >= len_cond + pad[:, None])
+
+        # The conditioning rows are shared by the whole batch: copy them in and only prefill the rest.
+        if prefix is not None:
+            for cache in caches:
+                for layer_idx in range(len(cache.key_cache)):
+                    cache.key_cache[layer_idx][:, :, :len_cond] = prefix.keys[layer_idx]
+                    cache.value_cache[layer_idx][:, :, :len_cond] = prefix.values[layer_idx]
+            inputs_embeds = inputs_embeds[:, len_cond:]
+            cache_position = cache_position[len_cond:]
+            if position_ids is not None:
+                position_ids = position_ids[:, len_cond:]
+
+        # One alignment analyzer per conditional row, all reading the attention of a single hooked layer
+        analyzers, spy, forced_at = [], None, {}
+        if alignment_stop:
+            stop_on = ("long_tail", "repetition") if alignment_stop is True else tuple(alignment_stop)
+            spy = AttentionSpy(self.tfmr, self.ALIGNMENT_LAYER_IDX)
+            text_end = len_cond + text_tokens.size(1)
+            analyzers = [
+                AlignmentStreamAnalyzer(
+                    self.tfmr,
+                    None,
+                    text_tokens_slice=(len_cond + (0 if pad is None else int(pad[row])), text_end),
+                    eos_idx=self.hp.stop_speech_token,
+                    row=row,
+                    spy=spy,
+                    stop_on=stop_on,
+                    suppress_early_eos=False,
+                )
+                for row in range(n_rows)
+            ]
+
+        if split_cfg:
+            uncond = dict(
+                mask=None if attention_mask is None else attention_mask[n_rows:],
+                pad=None if pad is None else pad[n_rows:],
+                position=seq_len,
+                pending=[],
+            )
+            uncond_logits = self.patched_model(
+                inputs_embeds=inputs_embeds[n_rows:],
+                past_key_values=uncond_cache,
+                cache_position=cache_position,
+                attention_mask=uncond["mask"],
+                position_ids=None if position_ids is None else position_ids[n_rows:],
+            )[:, -1, :]
+            # the conditional rows go on alone (prefilled last, so the attention spy sees them)
+            inputs_embeds = inputs_embeds[:n_rows]
+            if pad is not None:
+                attention_mask, position_ids, pad = attention_mask[:n_rows], position_ids[:n_rows], pad[:n_rows]
+
+        try:
+            # ---- Initial Forward Pass (no kv_cache yet) ----
+            output_logits = self.patched_model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=kv_cache,
+                cache_position=cache_position,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+            cache_position = cache_position[-1:] + 1
+
+            if speculative is not None:
+                sampling_probs = partial(
+                    self._sampling_probs,
+                    temperature=temperature,
+                    repetition_penalty_processor=repetition_penalty_processor,
+                    top_p_warper=top_p_warper,
+                )
+                yield from self._speculative_stream(
+                    speculative, output_logits, kv_cache, seq_len, generated_ids, max_new_tokens, draft_tokens,
+                    cfg_weight, tokens_per_slice, sampling_probs,
+                )
+                return
+
+            # Rows that already emitted EOS keep decoding (the batch is static) but their samples are discarded.
+            finished = torch.zeros(n_rows, dtype=torch.bool, device=device)
+            # the host hears of EOS asynchronously, a few steps late at most; the extra steps are trimmed below
+            finished_flag = FinishedFlag(device)
+            timer = StepTimer(device) if step_timing else None
+            n_yielded = 0
+
+            # ---- Generation Loop using kv_cache ----
+            # for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+            for i in range(max_new_tokens):
+                if timer is not None:
+                    timer.step_start()
+                logits = output_logits[:, -1, :]
+
+                # CFG
+                if split_cfg:
+                    if uncond_logits is not None:
+                        logits = logits + cfg_weight * (logits - uncond_logits)
+                elif cfg_weight > 0.0:
+                    logits_cond = logits[:n_rows]
+                    logits_uncond = logits[n_rows:]
+                    logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
+
+                # Force EOS on runaway rows
+                for row, analyzer in enumerate(analyzers):
+                    if bool(finished[row]):
+                        continue
+                    logits[row] = analyzer.step(logits[row:row + 1])[0]
+                    if analyzer.stop_reason is not None:
+                        forced_at.setdefault(row, i)
+
+                # Temperature, repetition penalty and top‑p sampling of the next token.
+                next_token = sampler(logits)  # shape: (N, 1)
+                next_token = next_token.masked_fill(finished[:, None], self.hp.stop_speech_token)
+
+                generated_ids[:, i + bos_len] = next_token[:, 0]
+                finished |= next_token[:, 0] == stop_token_tensor
+                finished_flag.update(finished)
+
+                # Get embedding for the new token.
+                next_token_embed = self._speech_embedding_cache[next_token] + self._speech_pos_embedding_cache[i + 1]
+
+                #  For CFG
+                if cfg_weight > 0.0 and not split_cfg:
+                    next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+                # Stream out the tokens of this slice.
+                if tokens_per_slice and (i + 1) % tokens_per_slice == 0:
+                    yield generated_ids[:, bos_len + n_yielded:bos_len + i + 1]
+                    n_yielded = i + 1
+
+                # Check for EOS token (at every step with the analyzers, which sync anyway).
+                if finished_flag.done() or (analyzers and bool(finished.all())):
+                    break
 
-            # Get embedding for the new token.
-            next_token_embed = self._speech_embedding_cache[next_token] + self._speech_pos_embedding_cache[i + 1]
+                # CFG schedule: the unconditional rows catch up when their logits are due, or are dropped
+                if split_cfg and uncond_logits is not None:
+                    uncond["pending"].append(next_token_embed)
+                    if cfg_steps is not None and i + 1 >= cfg_steps:
+                        uncond_logits = None
+                    elif (i + 1) % cfg_interval == 0:
+                        uncond_logits = self._uncond_catch_up(uncond, uncond_cache)
+
+                # Forward pass with only the new token and the cached past.
+                torch.compiler.cudagraph_mark_step_begin()
+                # the attention spy hooks a layer, which a compiled step would not see
+                step = partial(T3._step_compilation_target, self) if analyzers else self._step_compilation_target
+                if timer is not None:
+                    timer.forward_start()
+                output_logits = step(
+                    next_token_embed,
+                    kv_cache,
+                    cache_position,
+                    attention_mask,
+                    None if pad is None else cache_position[None] - pad[:, None],
+                )
+                if timer is not None:
+                    timer.forward_end()
+                cache_position = cache_position + 1
+
+            # Exact end: the step at which the last row emitted EOS
+            n_steps = i + 1
+            is_stop = generated_ids[:, bos_len:bos_len + n_steps] == stop_token_tensor
+            if bool(is_stop.any(dim=1).all()):
+                n_steps = int(is_stop.int().argmax(dim=1).max()) + 1
+            if n_steps > n_yielded:
+                yield generated_ids[:, bos_len + n_yielded:bos_len + n_steps]
+            if timer is not None:
+                self.last_step_stats = timer.summary()
+        finally:
+            if spy is not None:
+                spy.remove()
+                self._record_alignment_stats(analyzers, forced_at, max_new_tokens)
+
+    @staticmethod
+    def _sampling_probs(logits, history, temperature, repetition_penalty_processor, top_p_warper):
+        "The distribution the decode loop samples from: (t, V) logits and (t, L) token histories to (t, V) probs."
+        if temperature != 1.0:
+            logits = logits / temperature
+        logits = repetition_penalty_processor(history, logits)
+        logits = top_p_warper(None, logits)
+        return torch.softmax(logits.float(), dim=-1)
+
+    def _ngram_draft(self, ids: list, n_draft: int) -> list:
+        "What followed the latest earlier occurrence of the longest suffix of `ids` (up to `DRAFT_NGRAM` tokens)."
+        for size in range(min(self.DRAFT_NGRAM, len(ids) - 1), 0, -1):
+            suffix = ids[-size:]
+            for start in range(len(ids) - size - 1, -1, -1):
+                if ids[start:start + size] == suffix:
+                    return ids[start + size:start + size + n_draft]
+        return []
+
+    def _speculative_stream(
+        self,
+        mode,
+        output_logits,
+        kv_cache,
+        seq_len,
+        generated_ids,
+        max_new_tokens,
+        draft_tokens,
+        cfg_weight,
+        tokens_per_slice,
+        sampling_probs,
+    ):
+        """
+        Decode loop of `inference_stream(speculative=...)` after the prefill, for one row (and its CFG copy).
 
-            #  For CFG
-            if cfg_weight > 0.0:
-                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+        Every round, the last sampled token is pending (not in the cache yet). The draft proposes up to
+        `draft_tokens` tokens after it, with their draft distributions q (one-hot for "ngram"). The full model then
+        scores the pending token and the proposals in one forward pass, which also writes their key / values. Each
+        proposal x is accepted with probability min(1, p(x) / q(x)); the first rejected one is replaced by a sample
+        of max(0, p - q), and if all are accepted a bonus token is sampled from the last p. This keeps the tokens
+        distributed as if every one was sampled from p. Cache entries of rejected tokens are overwritten later, and
+        masked out until then.
 
-            # Check for EOS token.
-            if i > length_guesstimate and i % 20 == 0:
-                if (generated_ids == stop_token_tensor).any():
-                    break
-
-            # Forward pass with only the new token and the cached past.
-            torch.compiler.cudagraph_mark_step_begin()
-            output_logits = self._step_compilation_target(
-                next_token_embed,
-                kv_cache,
+        Column m of `generated_ids` holds token m (column 0 is BOS), so it is also the repetition penalty history.
+        """
+        t_start = time.perf_counter()
+        device = generated_ids.device
+        stop_token = self.hp.stop_speech_token
+        pad_token = int(generated_ids[0, -1])
+        n_batch = 2 if cfg_weight > 0.0 else 1
+        n_cols = generated_ids.size(1)
+        columns = torch.arange(n_cols, device=device)
+        stats = dict(mode=mode, rounds=0, drafted=0, accepted=0)
+
+        def guided(logits):
+            "(n_batch, t, V) logits of the row and its CFG copy to (t, V)"
+            if n_batch == 1:
+                return logits[0]
+            return logits[0] + cfg_weight * (logits[0] - logits[1])
+
+        def embed(tokens, first):
+            "(t,) tokens at speech positions first, ... to (n_batch, t, dim) inputs"
+            pos_emb = self._speech_pos_embedding_cache[first:first + len(tokens)].reshape(len(tokens), -1)
+            return (self._speech_embedding_cache[tokens] + pos_emb)[None].expand(n_batch, -1, -1)
+
+        def forward(tokens, n, num_layers=None):
+            "logits after feeding tokens n, n + 1, ... (token n sits at cache position seq_len + n - 1)"
+            cache_position = torch.arange(seq_len + n - 1, seq_len + n - 1 + len(tokens), device=device)
+            logits = self.patched_model(
+                inputs_embeds=embed(tokens, n),
+                past_key_values=kv_cache,
+                cache_position=cache_position,
+                num_layers=num_layers,
             )
-
-        
-        return torch.cat(predicted, dim=1)
+            return guided(logits)
+
+        # first token, from the prefill
+        probs = sampling_probs(guided(output_logits[:, -1:]), generated_ids)
+        generated_ids[0, 1] = torch.multinomial(probs, num_samples=1)[0, 0]
+        ids = generated_ids[0, :2].tolist()
+        n, n_yielded = 1, 0
+
+        while ids[-1] != stop_token and n < max_new_tokens:
+            n_draft = min(draft_tokens, max_new_tokens - n - 1)
+
+            # draft proposals after the pending token n, in columns n + 1, ...
+            if mode == "ngram":
+                proposals = self._ngram_draft(ids, n_draft)
+                n_draft = len(proposals)
+                drafted = torch.tensor(proposals, dtype=torch.long, device=device)
+                generated_ids[0, n + 1:n + 1 + n_draft] = drafted
+                q = F.one_hot(drafted, probs.size(-1)).float()
+            else:
+                q = []
+                for j in range(n_draft):
+                    draft_logits = forward(generated_ids[0, n + j:n + j + 1], n + j, num_layers=self.DRAFT_LAYERS)
+                    q.append(sampling_probs(draft_logits, generated_ids[:, :n + j + 1])[0])
+                    generated_ids[0, n + j + 1] = torch.multinomial(q[-1], num_samples=1)[0]
+                drafted = generated_ids[0, n + 1:n + 1 + n_draft]
+                q = torch.stack(q) if q else probs.new_zeros(0, probs.size(-1))
+
+            # verify: position r predicts column n + r + 1 from the history up to column n + r
+            logits = forward(generated_ids[0, n:n + n_draft + 1], n)
+            history = torch.where(
+                columns[None] <= n + torch.arange(n_draft + 1, device=device)[:, None],
+                generated_ids[0],
+                pad_token,
+            )
+            p = sampling_probs(logits, history)
+            rows = torch.arange(n_draft, device=device)
+            accepted = torch.rand(n_draft, device=device) * q[rows, drafted] <= p[rows, drafted]
+            n_accepted = int(accepted.long().cumprod(0).sum())
+
+            if n_accepted < n_draft:
+                residual = (p[n_accepted] - q[n_accepted]).clamp(min=0)
+                # p == q leaves nothing: any sample of p is then as good
+                residual = residual if bool(residual.sum() > 0) else p[n_accepted]
+                next_token = torch.multinomial(residual / residual.sum(), num_samples=1)[0]
+            else:
+                next_token = torch.multinomial(p[n_draft], num_samples=1)[0]
+            generated_ids[0, n + n_accepted + 1] = next_token
+            generated_ids[0, n + n_accepted + 2:n + n_draft + 1] = pad_token
+
+            stats["rounds"] += 1
+            stats["drafted"] += n_draft
+            stats["accepted"] += n_accepted
+            new_ids = generated_ids[0, n + 1:n + n_accepted + 2].tolist()
+            if stop_token in new_ids:
+                new_ids = new_ids[:new_ids.index(stop_token) + 1]
+            ids += new_ids
+            n += len(new_ids)
+
+            if tokens_per_slice and n - n_yielded >= tokens_per_slice:
+                yield generated_ids[:, 1 + n_yielded:1 + n]
+                n_yielded = n
+
+        if n > n_yielded:
+            yield generated_ids[:, 1 + n_yielded:1 + n]
+        self._record_speculative_stats(stats, n, time.perf_counter() - t_start)
+
+    def _record_speculative_stats(self, stats, n_tokens, seconds):
+        stats.update(
+            tokens=n_tokens,
+            seconds=seconds,
+            acceptance_rate=stats["accepted"] / max(stats["drafted"], 1),
+            tokens_per_round=n_tokens / max(stats["rounds"], 1),
+            tokens_per_s=n_tokens / seconds,
+        )
+        self.last_speculative_stats = stats
+        for k in self.speculative_counters:
+            self.speculative_counters[k] += stats[k]
+
+    def _uncond_catch_up(self, uncond: dict, cache: StaticCache):
+        "Feeds the tokens the unconditional rows have not seen yet in one pass, and returns their latest logits."
+        embeds = torch.cat(uncond["pending"], dim=1)
+        cache_position = torch.arange(uncond["position"], uncond["position"] + embeds.size(1), device=embeds.device)
+        logits = self.patched_model(
+            inputs_embeds=embeds,
+            past_key_values=cache,
+            cache_position=cache_position,
+            attention_mask=uncond["mask"],
+            position_ids=None if uncond["pad"] is None else cache_position[None] - uncond["pad"][:, None],
+        )
+        uncond["position"] += embeds.size(1)
+        uncond["pending"] = []
+        return logits[:, -1, :]
+
+    def _record_alignment_stats(self, analyzers, forced_at, max_new_tokens):
+        # a forced row would otherwise have run on, at worst until max_new_tokens
+        self.last_alignment_stats = []
+        for row, analyzer in enumerate(analyzers):
+            tokens_saved = max_new_tokens - forced_at[row] - 1 if row in forced_at else 0
+            self.last_alignment_stats.append(dict(
+                reason=analyzer.stop_reason,
+                stopped_at=forced_at.get(row),
+                tokens_saved=tokens_saved,
+            ))
+            self.alignment_counters["chunks"] += 1
+            self.alignment_counters["tokens_saved"] += tokens_saved
+            if analyzer.stop_reason is not None:
+                self.alignment_counters[analyzer.stop_reason] += 1
 
     # @torch.compile(backend="cudagraphs", fullgraph=True)
     def _step_compilation_target(
         self,
         next_token_embed: Tensor,
         kv_cache: StaticCache,
+        cache_position: Tensor,
+        attention_mask: Optional[Tensor] = None,
+        position_ids: Optional[Tensor] = None,
     ):
         return self.patched_model(
             inputs_embeds=next_token_embed,
             past_key_values=kv_cache,
-            cache_position=kv_cache.get_seq_length().unsqueeze(0),
+            cache_position=cache_position,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
         )
@@ -1,16 +1,20 @@
+import hashlib
+import logging
+import time
+from contextlib import closing
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Literal
+from typing import Literal, Optional
 
 import librosa
 import torch
 # import perth
 import torch.nn.functional as F
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
+from .loading import DEFAULT_MANIFEST, load_module, resolve_checkpoint
 from .models.t3 import T3
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.t3.inference.sampler import chunk_seed
+from .models.s3tokenizer import EOS, S3_SR, SOS, SPEECH_VOCAB_SIZE
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
@@ -19,6 +23,8 @@ from .models.t3.modules.cond_enc import T3Cond
 
 REPO_ID = "ResembleAI/chatterbox"
 
+logger = logging.getLogger(__name__)
+
 
 def punc_norm(text: str) -> str:
     """
@@ -96,6 +102,27 @@ class Conditionals:
         )
         torch.save(arg_dict, fpath)
 
+    def checksum(self) -> str:
+        """
+        Hash of the voice: the T3 speaker conditioning and the S3Gen reference. Exaggeration is left out.
+
+        Computed on the first call only (it copies every tensor to the host), so the voice tensors must not be
+        modified in place afterwards.
+        """
+        if not hasattr(self, "_checksum"):
+            h = hashlib.sha1()
+            tensors = [self.t3.speaker_emb, self.t3.cond_prompt_speech_tokens]
+            tensors += [self.gen[k] for k in sorted(self.gen) if torch.is_tensor(self.gen[k])]
+            for t in tensors:
+                if t is None:
+                    h.update(b"none")
+                    continue
+                t = t.detach().float().cpu().contiguous()
+                h.update(str(tuple(t.shape)).encode())
+                h.update(t.numpy().tobytes())
+            self._checksum = h.hexdigest()
+        return self._checksum
+
     @classmethod
     def load(cls, fpath, map_location="cpu"):
         if isinstance(map_location, str):
@@ -103,10 +130,28 @@ class Conditionals:
         kwargs = torch.load(fpath, map_location=map_location, weights_only=True)
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
+    GEN_KEYS = ("prompt_token", "prompt_token_len", "prompt_feat", "prompt_feat_len", "embedding")
+
+    def to_tensors(self) -> dict:
+        """Flat dict of contiguous CPU tensors ("t3.<field>", "gen.<key>") for safetensors. None values are left out."""
+        tensors = {f"t3.{k}": v for k, v in self.t3.__dict__.items() if torch.is_tensor(v)}
+        tensors.update({f"gen.{k}": v for k, v in self.gen.items() if torch.is_tensor(v)})
+        return {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+
+    @classmethod
+    def from_tensors(cls, tensors: dict):
+        """Inverse of `to_tensors`. The tensors are used as they are (e.g. memory-mapped), call `to` to move them."""
+        t3 = {k[len("t3."):]: v for k, v in tensors.items() if k.startswith("t3.")}
+        gen = {k: tensors.get(f"gen.{k}") for k in cls.GEN_KEYS}
+        return cls(T3Cond(**t3), gen)
+
 
 class ChatterboxTTS:
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
+    # ref_crop="auto": S3Gen prompt of REF_CROP_RATIO x the chunk's speech tokens, at least REF_CROP_MIN_TOKENS (25 / s)
+    REF_CROP_RATIO = 1.0
+    REF_CROP_MIN_TOKENS = 75
 
     def __init__(
         self,
@@ -124,11 +169,45 @@ class ChatterboxTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.ckpt_dir = None
+        # cold-start breakdown in seconds, filled by from_local / from_pretrained
+        self.load_stats = {}
+        # text and speech tokens of the chunks generated with `conds` that ended with EOS, see `_record_lengths`
+        self.speech_rate_stats = dict(conds=None, chunks=0, text_tokens=0, speech_tokens=0)
         # self.watermarker = perth.PerthImplicitWatermarker()
 
+    @property
+    def checksum(self) -> str:
+        """
+        Fingerprint of the loaded checkpoint: size plus the first and last MiB of every checkpoint file, which is
+        enough to tell checkpoints apart without hashing gigabytes of weights.
+        """
+        if not hasattr(self, "_checksum"):
+            h = hashlib.sha1()
+            if self.ckpt_dir is not None:
+                for fpath in sorted(Path(self.ckpt_dir).iterdir()):
+                    if fpath.suffix not in (".safetensors", ".json", ".pt"):
+                        continue
+                    size = fpath.stat().st_size
+                    h.update(f"{fpath.name}:{size}".encode())
+                    with open(fpath, "rb") as f:
+                        h.update(f.read(1 << 20))
+                        f.seek(max(0, size - (1 << 20)))
+                        h.update(f.read(1 << 20))
+            self._checksum = h.hexdigest()
+        return self._checksum
+
+    MODEL_FILES = ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]
+
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, t3_dtype=None) -> 'ChatterboxTTS':
+        """
+        Loads the model from a checkpoint directory. The modules are built without initializing their weights,
+        which are assigned from the memory-mapped checkpoints instead (see `loading.load_module`). With `t3_dtype`,
+        the T3 weights are cast while loading, rather than converted after the fact.
+        """
         ckpt_dir = Path(ckpt_dir)
+        load_stats = {}
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
         if device in ["cpu", "mps"]:
@@ -136,25 +215,22 @@ class ChatterboxTTS:
         else:
             map_location = None
 
-        ve = VoiceEncoder()
-        ve.load_state_dict(
-            load_file(ckpt_dir / "ve.safetensors")
-        )
-        ve.to(device).eval()
-
-        t3 = T3()
-        t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        t3.to(device).eval()
-
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
-        s3gen.to(device).eval()
+        start = time.perf_counter()
+        ve = load_module(VoiceEncoder, ckpt_dir / "ve.safetensors", device, stats=load_stats, stats_key="ve")
+        load_stats["ve"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        t3 = load_module(T3, ckpt_dir / "t3_cfg.safetensors", device, dtype=t3_dtype,
+                         state_fn=lambda state: state["model"][0] if "model" in state.keys() else state,
+                         stats=load_stats, stats_key="t3")
+        load_stats["t3"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        s3gen = load_module(S3Gen, ckpt_dir / "s3gen.safetensors", device, strict=False, stats=load_stats,
+                            stats_key="s3gen")
+        load_stats["s3gen"] = time.perf_counter() - start
 
+        start = time.perf_counter()
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
         )
@@ -162,11 +238,19 @@ class ChatterboxTTS:
         conds = None
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
+        load_stats["tokenizer+conds"] = time.perf_counter() - start
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        model = cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        model.ckpt_dir = ckpt_dir
+        model.load_stats = load_stats
+        return model
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, t3_dtype=None, manifest_path=DEFAULT_MANIFEST) -> 'ChatterboxTTS':
+        """
+        Loads the released checkpoint. Its files are resolved through a local manifest, so the hub is only contacted
+        when they are not on disk yet (see `loading.resolve_checkpoint`).
+        """
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -175,10 +259,15 @@ class ChatterboxTTS:
                 print("MPS not available because the current MacOS version is not 12.3+ and/or you do not have an MPS-enabled device on this machine.")
             device = "cpu"
 
-        for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
-            local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
+        start = time.perf_counter()
+        ckpt_dir = resolve_checkpoint(REPO_ID, cls.MODEL_FILES, manifest_path)
+        resolve_time = time.perf_counter() - start
 
-        return cls.from_local(Path(local_path).parent, device)
+        model = cls.from_local(ckpt_dir, device, t3_dtype=t3_dtype)
+        model.load_stats = dict(resolve=resolve_time, **model.load_stats)
+        model.load_stats["total"] = time.perf_counter() - start
+        logger.info("Cold start: " + ", ".join(f"{k} {v:.2f}s" for k, v in model.load_stats.items()))
+        return model
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
         ## Load reference wav
@@ -206,6 +295,111 @@ class ChatterboxTTS:
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
 
+    def count_text_tokens(self, text: str) -> int:
+        """Number of T3 text tokens of `text`, without the start / stop tokens."""
+        return len(self.tokenizer.encode(text))
+
+    @property
+    def speech_tokens_per_text_token(self) -> Optional[float]:
+        """
+        Speech tokens decoded per text token with the current voice, measured over the chunks generated so far
+        that ended with EOS. None until such a chunk was generated, see `measure_speech_rate`.
+        """
+        stats = self.speech_rate_stats
+        if stats["conds"] is not self.conds or stats["text_tokens"] == 0:
+            return None
+        return stats["speech_tokens"] / stats["text_tokens"]
+
+    def measure_speech_rate(self, texts: list[str], max_new_tokens=1000, max_cache_len=1500, seed: int = 0,
+                            **t3_kwargs) -> float:
+        """
+        Decodes `texts` as one batch with T3 alone (no audio) and returns the measured
+        `speech_tokens_per_text_token`, which replaces the running estimate of the current voice. A few ordinary
+        sentences of the text to synthesize are enough; the ratio depends on the voice (its speaking rate) and on
+        the text (e.g. its punctuation and pauses).
+
+        Every text is sampled from its own stream derived from `seed` (see `chunk_seed`), so the same voice, texts
+        and parameters always measure the same ratio. `t3_kwargs` (e.g. `cfg_weight`, `temperature`) are passed
+        to `T3.inference`.
+        """
+        assert self.conds is not None, "Please `prepare_conditionals` first"
+        t3_kwargs.setdefault("cfg_weight", 0.5)
+        t3_kwargs.setdefault("seeds", [chunk_seed(seed, punc_norm(t)) for t in texts])
+        text_tokens, text_token_lens = self._text_tokens(texts, t3_kwargs["cfg_weight"] > 0.0)
+        with torch.inference_mode():
+            speech_tokens = self.t3.inference(t3_cond=self.conds.t3, text_tokens=text_tokens,
+                                              text_token_lens=text_token_lens, max_new_tokens=max_new_tokens,
+                                              max_cache_len=max_cache_len, **t3_kwargs)
+        self.speech_rate_stats.update(conds=self.conds, chunks=0, text_tokens=0, speech_tokens=0)
+        self._record_lengths(texts, text_token_lens, speech_tokens, max_new_tokens)
+        assert self.speech_tokens_per_text_token is not None, "No sample reached EOS within max_new_tokens"
+        return self.speech_tokens_per_text_token
+
+    def text_token_budget(self, max_new_tokens=1000, max_cache_len=1500, speech_tokens_per_text_token=None,
+                          headroom=0.8) -> int:
+        """
+        Largest number of text tokens per chunk such that the prefill plus `max_new_tokens` fits the static cache,
+        and the expected speech length (`speech_tokens_per_text_token` per text token) stays within `headroom` of
+        `max_new_tokens`, so that speech is not cut off.
+
+        The ratio defaults to the one measured with the current voice, so run `measure_speech_rate` (or generate
+        some chunks) first, or pass it explicitly.
+        """
+        assert self.conds is not None, "Please `prepare_conditionals` first"
+        if speech_tokens_per_text_token is None:
+            speech_tokens_per_text_token = self.speech_tokens_per_text_token
+            assert speech_tokens_per_text_token is not None, \
+                "The speech / text token ratio of this voice is not measured yet, see `measure_speech_rate`"
+        with torch.inference_mode():
+            len_cond = self.t3.prepare_conditioning(self.conds.t3).size(1)
+        # start / stop text tokens, punc_norm's full stop and the start speech token
+        overhead = 4
+        cache_budget = max_cache_len - len_cond - max_new_tokens - overhead
+        speech_budget = int(max_new_tokens * headroom / speech_tokens_per_text_token) - overhead
+        budget = min(cache_budget, speech_budget)
+        assert budget > 0, f"max_cache_len {max_cache_len} leaves no room for text with max_new_tokens {max_new_tokens}"
+        return budget
+
+    def _text_tokens(self, texts: list[str], cfg: bool):
+        """Normalized, tokenized and padded `texts` with their lengths, repeated for the unconditional rows of CFG."""
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = []
+        for t in texts:
+            tokens = self.tokenizer.text_to_tokens(punc_norm(t)).squeeze(0).to(self.device)
+            tokens = F.pad(tokens, (1, 0), value=sot)
+            tokens = F.pad(tokens, (0, 1), value=eot)
+            text_tokens.append(tokens)
+        text_token_lens = torch.tensor([len(t) for t in text_tokens], dtype=torch.long, device=self.device)
+        text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True, padding_value=eot)
+
+        if cfg:
+            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+            text_token_lens = torch.cat([text_token_lens, text_token_lens], dim=0)
+        return text_tokens, text_token_lens
+
+    def _record_lengths(self, texts: list[str], text_token_lens, speech_tokens, max_new_tokens):
+        """
+        Adds the chunks that ended with EOS to `speech_rate_stats`, and warns about the ones that ran into
+        `max_new_tokens`, whose speech is most likely cut off.
+        """
+        is_eos = speech_tokens[:len(texts)] == EOS
+        has_eos = is_eos.any(dim=1).tolist()
+        eos_at = is_eos.int().argmax(dim=1).tolist()
+        # without the start / stop text tokens
+        n_text = (text_token_lens[:len(texts)] - 2).tolist()
+        stats = self.speech_rate_stats
+        if stats["conds"] is not self.conds:
+            stats.update(conds=self.conds, chunks=0, text_tokens=0, speech_tokens=0)
+        for text, eos, n_speech, n_text_tokens in zip(texts, has_eos, eos_at, n_text):
+            if not eos:
+                logger.warning(f"Reached max_new_tokens ({max_new_tokens}) without EOS, the speech is likely cut "
+                               f"off: {text[:80]!r}")
+                continue
+            stats["chunks"] += 1
+            stats["text_tokens"] += n_text_tokens
+            stats["speech_tokens"] += n_speech
+
     def generate(
         self,
         text,
@@ -214,17 +408,48 @@ class ChatterboxTTS:
         cfg_weight=0.5,
         temperature=0.8,
         repetition_penalty=1.0,
-        # stream - left for API compatibility
+        # stream: yield audio every `tokens_per_slice` speech tokens (single text only)
         tokens_per_slice=None,
+        # left for API compatibility
         remove_milliseconds=None,
         remove_milliseconds_start=None,
         chunk_overlap_method=None,
         # cache optimization params
         max_new_tokens=1000, 
         max_cache_len=1500, # Affects the T3 speed, hence important
+        cache_cond_prefix=True, # prefill the voice conditioning once and reuse it across calls
+        # force EOS on runaway generations (long tails, repetitions) seen in the T3 alignment, see `T3.inference_stream`
+        alignment_stop=None,
+        # CFG schedule: guide only the first `cfg_steps` tokens, and / or refresh the unconditional logits every
+        # `cfg_interval` steps (see `T3.inference_stream`)
+        cfg_steps=None,
+        cfg_interval=1,
+        # speculative T3 decoding of a single text: draft with the first decoder layers ("layers") or with repeats of
+        # the tokens so far ("ngram"), `draft_tokens` at a time (see `T3.inference_stream`)
+        speculative=None,
+        draft_tokens=4,
+        # one T3 sampler seed per text, which then gets the same speech tokens in any batch (see `chunk_seed`)
+        seeds=None,
+        # time every T3 decode step, see `T3.last_step_stats`
+        step_timing=False,
+        # S3Gen reference prompt: None for the full reference, a number of tokens, or "auto" to scale with the chunk
+        ref_crop=None,
+        # S3Gen CFM decoder: number of ODE steps, solver ("euler", "heun", "midpoint", "multistep") and time schedule
+        cfm_steps=10,
+        cfm_solver="euler",
+        cfm_schedule=None,
+        # S3Gen renders up to this many texts of a batch at once. The mels of shorter texts are padded to the longest
+        # one, and HiFT vocodes the padding too, so the audio differs slightly from rendering each text on its own
+        s3gen_batch_size=1,
     ):
-        if tokens_per_slice is not None or remove_milliseconds is not None or remove_milliseconds_start is not None or chunk_overlap_method is not None:
-            print("Streaming by token slices has been discontinued due to audio clipping. Continuing with full generation.")
+        if remove_milliseconds is not None or remove_milliseconds_start is not None or chunk_overlap_method is not None:
+            print("Chunk trimming / overlap options are no longer used; streamed chunks are cross-faded instead.")
+        if tokens_per_slice is not None and not isinstance(text, str):
+            print("Streaming by token slices needs a single text. Continuing with full generation.")
+            tokens_per_slice = None
+        if speculative is not None and not isinstance(text, str):
+            print("Speculative decoding needs a single text. Continuing with batched decoding.")
+            speculative = None
 
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
@@ -240,63 +465,157 @@ class ChatterboxTTS:
                 emotion_adv=exaggeration * torch.ones(1, 1, 1),
             ).to(device=self.device)
 
-        # Norm and tokenize text
-        if isinstance(text, str):
-            text = punc_norm(text)
-            text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
-        else: # text is a list of strings. Doesn't work yet
-            text_tokens = [self.tokenizer.text_to_tokens(punc_norm(t)).squeeze(0).to(self.device) for t in text]
-            print(len(text_tokens), text_tokens[0].shape)
-            text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True)
-            assert False, "not implemented"
-
-
-        if cfg_weight > 0.0:
-            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
-
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        # Norm and tokenize text. A list of strings is decoded as one batch, one output per string.
+        texts = [text] if isinstance(text, str) else list(text)
+        text_tokens, text_token_lens = self._text_tokens(texts, cfg_weight > 0.0)
+
+        t3_kwargs = dict(
+            t3_cond=self.conds.t3,
+            text_tokens=text_tokens,
+            text_token_lens=text_token_lens,
+            max_new_tokens=max_new_tokens,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            max_cache_len=max_cache_len,
+            repetition_penalty=repetition_penalty,
+            cache_cond_prefix=cache_cond_prefix,
+            alignment_stop=alignment_stop,
+            cfg_steps=cfg_steps,
+            cfg_interval=cfg_interval,
+            speculative=speculative,
+            draft_tokens=draft_tokens,
+            seeds=seeds,
+            step_timing=step_timing,
+        )
+        s3gen_kwargs = dict(n_timesteps=cfm_steps, solver=cfm_solver, t_scheduler=cfm_schedule)
+        if tokens_per_slice is not None:
+            yield from self._generate_stream(t3_kwargs, tokens_per_slice, s3gen_kwargs, texts)
+            return
 
         with torch.inference_mode():
-            speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
-                text_tokens=text_tokens,
-                max_new_tokens=max_new_tokens,  # TODO: use the value in config
-                temperature=temperature,
-                cfg_weight=cfg_weight,
-                max_cache_len=max_cache_len,
-                repetition_penalty=repetition_penalty,
-            )
-
-            
-            def speech_to_wav(speech_tokens):
-                # Extract only the conditional batch.
-                speech_tokens = speech_tokens[0]
-
-                # TODO: output becomes 1D
-                speech_tokens = drop_invalid_tokens(speech_tokens)
-                
-                def drop_bad_tokens(tokens):
-                    # Use torch.where instead of boolean indexing to avoid sync
-                    mask = tokens < 6561
-                    # Count valid tokens without transferring to CPU
-                    valid_count = torch.sum(mask).item()
-                    # Create output tensor of the right size
-                    result = torch.zeros(valid_count, dtype=tokens.dtype, device=tokens.device)
-                    # Use torch.masked_select which is more CUDA-friendly
-                    result = torch.masked_select(tokens, mask)
-                    return result
-
-                # speech_tokens = speech_tokens[speech_tokens < 6561]
-                speech_tokens = drop_bad_tokens(speech_tokens)
-                wav, _ = self.s3gen.inference(
-                    speech_tokens=speech_tokens,
+            speech_tokens = self.t3.inference(**t3_kwargs)
+            self._record_lengths(texts, text_token_lens, speech_tokens, max_new_tokens)
+            if len(speech_tokens) == 1 or s3gen_batch_size <= 1:
+                for row in speech_tokens:
+                    yield self._speech_to_wav(row, ref_crop=ref_crop, **s3gen_kwargs)
+            else:
+                yield from self._speech_to_wavs(speech_tokens, s3gen_batch_size, ref_crop=ref_crop, **s3gen_kwargs)
+
+    @staticmethod
+    def _clean_speech_tokens(speech_tokens):
+        """
+        The speech tokens between SOS and EOS, without special tokens. The whole selection is masked on the device,
+        so the only host sync is the one for the output length.
+        """
+        x = speech_tokens.squeeze(0)
+        n = x.size(0)
+        if n == 0:
+            return x
+        idx = torch.arange(n, device=x.device)
+        sos = torch.where(x == SOS, idx, n).min()
+        eos = torch.where(x == EOS, idx, n).min()
+        start = torch.where(sos < n, sos + 1, 0)
+        keep = (idx >= start) & (idx < eos) & (x < SPEECH_VOCAB_SIZE)
+        return torch.masked_select(x, keep)
+
+    def _max_prompt_tokens(self, speech_tokens, ref_crop):
+        if ref_crop != "auto":
+            return ref_crop
+        max_prompt_tokens = max(self.REF_CROP_MIN_TOKENS, int(self.REF_CROP_RATIO * speech_tokens.shape[-1]))
+        # whole seconds, so that chunks of similar length share the cached prompt
+        return -(-max_prompt_tokens // 25) * 25
+
+    def _speech_to_wav(self, speech_tokens, ref_crop=None, **s3gen_kwargs):
+        speech_tokens = self._clean_speech_tokens(speech_tokens)
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=self.conds.gen,
+            max_prompt_tokens=self._max_prompt_tokens(speech_tokens, ref_crop),
+            **s3gen_kwargs,
+        )
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = wav #self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def _speech_to_wavs(self, speech_tokens, batch_size, ref_crop=None, **s3gen_kwargs):
+        """
+        Batched `_speech_to_wav` of the rows of `speech_tokens`, yielded in order. Rows are grouped by S3Gen prompt
+        length (which differs per row with `ref_crop="auto"`) and sorted by length, so that each batch of at most
+        `batch_size` rows shares a prompt and wastes little padding.
+        """
+        rows = [self._clean_speech_tokens(row) for row in speech_tokens]
+        groups = {}
+        for i in sorted(range(len(rows)), key=lambda i: len(rows[i])):
+            groups.setdefault(self._max_prompt_tokens(rows[i], ref_crop), []).append(i)
+
+        wavs = [None] * len(rows)
+        for max_prompt_tokens, indices in groups.items():
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                batch_wavs = self.s3gen.batch_inference(
+                    [rows[i] for i in batch],
                     ref_dict=self.conds.gen,
+                    max_prompt_tokens=max_prompt_tokens,
+                    **s3gen_kwargs,
+                )
+                for i, wav in zip(batch, batch_wavs):
+                    wavs[i] = wav.detach().cpu()
+        yield from wavs
+
+    def _generate_stream(self, t3_kwargs, tokens_per_slice, s3gen_kwargs, texts):
+        """
+        Yields audio every `tokens_per_slice` speech tokens while T3 is still decoding.
+
+        S3Gen needs `pre_lookahead_len` tokens past the end of a chunk, so a chunk is emitted once that many
+        extra tokens are available; the remainder is flushed with `finalize=True` after EOS.
+        Timings of the last stream are kept in `self.stream_stats`.
+        """
+        t_start = time.perf_counter()
+        lookahead = self.s3gen.flow.pre_lookahead_len
+        stop_token = self.t3.hp.stop_speech_token
+        token_offset = 0
+        cache = None
+        pieces = []
+        stats = dict(time_to_first_audio=None, n_chunks=0, n_tokens=0, audio_seconds=0.0, total_time=None)
+
+        def emit(wav):
+            if stats["time_to_first_audio"] is None:
+                stats["time_to_first_audio"] = time.perf_counter() - t_start
+                logger.info(f"time to first audio: {stats['time_to_first_audio']:.3f}s")
+            stats["n_chunks"] += 1
+            stats["audio_seconds"] += wav.shape[-1] / self.sr
+            return wav.detach().cpu()
+
+        # the decode loop is closed explicitly, so that it cleans up (hooks, stats) as soon as EOS is seen
+        t3_stream = self.t3.inference_stream(tokens_per_slice=tokens_per_slice, **t3_kwargs)
+        with torch.inference_mode():
+            with closing(t3_stream):
+                for new_tokens in t3_stream:
+                    pieces.append(new_tokens[0])
+                    if (new_tokens[0] == stop_token).any():
+                        break
+                    speech_tokens = self._clean_speech_tokens(torch.cat(pieces))
+                    while speech_tokens.size(0) - token_offset >= tokens_per_slice + lookahead:
+                        end = token_offset + tokens_per_slice + lookahead
+                        wav, cache = self.s3gen.stream_inference(
+                            speech_tokens[:end], token_offset, self.conds.gen, cache=cache, finalize=False,
+                            **s3gen_kwargs,
+                        )
+                        token_offset += tokens_per_slice
+                        yield emit(wav)
+
+            self._record_lengths(texts, t3_kwargs["text_token_lens"], torch.cat(pieces)[None],
+                                 t3_kwargs["max_new_tokens"])
+            speech_tokens = self._clean_speech_tokens(torch.cat(pieces))
+            stats["n_tokens"] = speech_tokens.size(0)
+            if speech_tokens.size(0) > token_offset:
+                wav, _ = self.s3gen.stream_inference(
+                    speech_tokens, token_offset, self.conds.gen, cache=cache, finalize=True, **s3gen_kwargs,
                 )
-                wav = wav.squeeze(0).detach().cpu().numpy()
-                watermarked_wav = wav #self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-                return torch.from_numpy(watermarked_wav).unsqueeze(0)
+                yield emit(wav)
+            elif cache is not None:
+                # nothing left to vocode: flush the held-back overlap
+                yield emit(cache["speech"])
 
-            yield speech_to_wav(speech_tokens)
+        stats["total_time"] = time.perf_counter() - t_start
+        self.stream_stats = stats
@@ -3,9 +3,8 @@ from pathlib import Path
 import librosa
 import torch
 # import perth
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
+from .loading import DEFAULT_MANIFEST, load_module, resolve_checkpoint
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
 
@@ -50,16 +49,12 @@ class ChatterboxVC:
             states = torch.load(builtin_voice, map_location=map_location)
             ref_dict = states['gen']
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
-        s3gen.to(device).eval()
+        s3gen = load_module(S3Gen, ckpt_dir / "s3gen.safetensors", device, strict=False)
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxVC':
+    def from_pretrained(cls, device, manifest_path=DEFAULT_MANIFEST) -> 'ChatterboxVC':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -68,10 +63,8 @@ class ChatterboxVC:
                 print("MPS not available because the current MacOS version is not 12.3+ and/or you do not have an MPS-enabled device on this machine.")
             device = "cpu"
             
-        for fpath in ["s3gen.safetensors", "conds.pt"]:
-            local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
-
-        return cls.from_local(Path(local_path).parent, device)
+        ckpt_dir = resolve_checkpoint(REPO_ID, ["s3gen.safetensors", "conds.pt"], manifest_path)
+        return cls.from_local(ckpt_dir, device)
 
     def set_target_voice(self, wav_fpath):
         ## Load reference wav
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RenderManifest:
+    """
+    A persistent record of the rendered chunks of a book, so that an interrupted run can resume.
+
+    Every chunk is keyed by (book, paragraph index, chunk index) and stores a hash of its normalized text, the
+    generation parameters and where its audio lives (file, sample offset and length). A chunk is reused on a
+    later run only if its text and parameters are unchanged and its audio file still exists.
+
+    Values the chunking depends on (e.g. the measured speech rate of the voice) are stored next to the chunks, per
+    book and parameters, so that a resumed run splits the book exactly as before.
+    """
+
+    def __init__(self, path: str, book: str, params: dict):
+        """
+        Args:
+            path (str): Path of the SQLite database. Created if missing.
+            book (str): Key of the book, e.g. its input path.
+            params (dict): Generation parameters (voice, exaggeration, cfg_weight, ...). Must be JSON serializable.
+        """
+        self.path = path
+        self.book = book
+        self.params = json.dumps(params, sort_keys=True)
+        self.params_hash = hashlib.sha1(self.params.encode()).hexdigest()
+
+        self._lock = threading.Lock()
+        # a busy writer in another thread or process makes us wait instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                book TEXT NOT NULL,
+                paragraph INTEGER NOT NULL,
+                chunk INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                output TEXT NOT NULL,
+                sample_offset INTEGER NOT NULL,
+                num_samples INTEGER NOT NULL,
+                metrics TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (book, paragraph, chunk)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS book_values (
+                book TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (book, params_hash, name)
+            )
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def done_chunks(self, paragraph: int, chunks: list[str]) -> dict[int, dict]:
+        """
+        Returns the entries of the chunks of a paragraph that are already rendered with the current text and
+        parameters, keyed by chunk index.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk, text_hash, params_hash, output, sample_offset, num_samples, metrics "
+                "FROM chunks WHERE book = ? AND paragraph = ?",
+                (self.book, paragraph),
+            ).fetchall()
+
+        done = {}
+        for chunk, text_hash, params_hash, output, offset, n_samples, metrics in rows:
+            if chunk >= len(chunks) or params_hash != self.params_hash or text_hash != self.text_hash(chunks[chunk]):
+                continue
+            if not os.path.exists(output):
+                continue
+            done[chunk] = dict(
+                output=output,
+                sample_offset=offset,
+                num_samples=n_samples,
+                metrics=json.loads(metrics) if metrics is not None else None,
+            )
+        return done
+
+    @staticmethod
+    def load_audio(entry: dict):
+        """Loads the (1, T) audio of an entry returned by `done_chunks`."""
+        import torchaudio
+        wav, _ = torchaudio.load(entry["output"], frame_offset=entry["sample_offset"], num_frames=entry["num_samples"])
+        return wav
+
+    def record(self, paragraph: int, chunks: list[str], num_samples: list[int], output: str,
+               metrics: Optional[list] = None):
+        """
+        Records all chunks of a paragraph, written back to back into `output`.
+        """
+        offsets = [sum(num_samples[:i]) for i in range(len(num_samples))]
+        metrics = metrics if metrics is not None else [None] * len(chunks)
+        now = time.time()
+        rows = [
+            (self.book, paragraph, i, self.text_hash(text), self.params_hash, self.params, output, offset, n,
+             json.dumps(m, default=float) if m is not None else None, now)
+            for i, (text, offset, n, m) in enumerate(zip(chunks, offsets, num_samples, metrics))
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            # the paragraph may have lost chunks since the last run
+            self._conn.execute(
+                "DELETE FROM chunks WHERE book = ? AND paragraph = ? AND chunk >= ?",
+                (self.book, paragraph, len(chunks)),
+            )
+
+    def get_value(self, name: str):
+        """The value stored under `name` for this book and parameters, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM book_values WHERE book = ? AND params_hash = ? AND name = ?",
+                (self.book, self.params_hash, name),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_value(self, name: str, value):
+        """Stores a JSON serializable `value` under `name` for this book and parameters."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO book_values VALUES (?, ?, ?, ?, ?)",
+                (self.book, self.params_hash, name, json.dumps(value), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
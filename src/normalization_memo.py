@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from importlib import metadata
+
+logger = logging.getLogger(__name__)
+
+
+def _nemo_version() -> str:
+    try:
+        return metadata.version("nemo_text_processing")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+class NormalizationMemo:
+    """
+    A persistent memo of normalized text, shared across books, runs and processes.
+
+    Entries are keyed by the hash of the input text together with everything the output depends on: the NeMo
+    version, input_case, lang and punct_post_process. The store is a SQLite database in WAL mode, so several
+    normalization workers can read and write it at the same time.
+    """
+
+    def __init__(self, path: str, input_case: str = 'cased', lang: str = 'en'):
+        """
+        Args:
+            path (str): Path of the SQLite database. Created if missing.
+            input_case (str): The input case of the normalizer.
+            lang (str): The language of the normalizer.
+        """
+        self.path = path
+        self.input_case = input_case
+        self.lang = lang
+        self.nemo_version = _nemo_version()
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # a busy writer in another process makes us wait instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS normalized (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def key(self, text: str, punct_post_process: bool) -> str:
+        payload = "\0".join([self.nemo_version, self.input_case, self.lang, str(punct_post_process), text])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: list[str], punct_post_process: bool) -> list:
+        """Returns the memoized normalization of each text, or None where there is none."""
+        keys = [self.key(t, punct_post_process) for t in texts]
+        found = {}
+        with self._lock:
+            # stay below SQLite's limit on the number of bound parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, text FROM normalized WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update(rows)
+        results = [found.get(k) for k in keys]
+        n_found = sum(r is not None for r in results)
+        self.hits += n_found
+        self.misses += len(results) - n_found
+        return results
+
+    def put_many(self, texts: list[str], normalized: list[str], punct_post_process: bool):
+        rows = [(self.key(t, punct_post_process), n) for t, n in zip(texts, normalized)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO normalized VALUES (?, ?)", rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
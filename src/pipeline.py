@@ -0,0 +1,192 @@
+import itertools
+import logging
+import queue
+import threading
+from typing import Callable, Iterable, Optional
+
+from .manifest import RenderManifest
+from .text_preprocess import TextChunk
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream between stages
+_DONE = object()
+
+class AudiobookPipeline:
+    """
+    Renders paragraphs through a chain of bounded stages, so that text preparation, synthesis, verification and
+    encoding of different paragraphs overlap:
+
+        text prep (e.g. `TextProcessor.iter_normalized_book`) -> synthesis (calling thread)
+            -> verification (thread) -> encoding (thread)
+
+    Every stage hands its results over through a bounded queue, so a slow consumer stalls its producer instead
+    of letting work pile up in memory. The verification stage collects the chunks of several paragraphs, up to
+    `verify_batch_size`, and verifies them with a single call, so that e.g. speech recognition runs in batches.
+    An exception in any stage stops the others and is re-raised by `run`.
+
+    With a `RenderManifest`, chunks that were already rendered with the same text and parameters are loaded
+    back instead of synthesized, and paragraphs whose chunks are all done are skipped altogether.
+    """
+
+    def __init__(
+        self,
+        synthesize: Callable[[list[str]], list],
+        verify: Callable[[list[str], list], list],
+        write: Callable[[int, list[str], list, list], Optional[str]],
+        queue_size: int = 4,
+        manifest: Optional[RenderManifest] = None,
+        on_skip: Optional[Callable[[int], None]] = None,
+        verify_batch_size: int = 16,
+    ):
+        """
+        Args:
+            synthesize: maps the normalized chunks of a paragraph to one waveform per chunk.
+            verify: maps (chunks, waveforms) to one metrics entry per chunk.
+            write: stores (paragraph index, chunks, waveforms, metrics) and returns the output path, where the
+                waveforms are written back to back.
+            queue_size (int): Capacity of each queue between stages.
+            manifest (Optional[RenderManifest]): Record of the rendered chunks, used to resume a run.
+            on_skip: called with the index of every paragraph skipped because it is already rendered.
+            verify_batch_size (int): Number of new chunks the verification stage waits for before calling `verify`
+                (fewer at the end of the book).
+        """
+        self.synthesize = synthesize
+        self.verify = verify
+        self.write = write
+        self.queue_size = queue_size
+        self.manifest = manifest
+        self.on_skip = on_skip
+        self.verify_batch_size = verify_batch_size
+
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, q: queue.Queue, item):
+        # Block while the queue is full (backpressure), but give up if another stage failed.
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, e: BaseException):
+        logger.exception("pipeline stage failed")
+        self._errors.append(e)
+        self._stop.set()
+
+    def _stage(self, fn: Callable, in_q: queue.Queue, out_q: queue.Queue | None):
+        try:
+            while (item := self._get(in_q)) is not _DONE:
+                result = fn(*item)
+                if out_q is not None and not self._put(out_q, result):
+                    return
+        except BaseException as e:
+            self._fail(e)
+            return
+        if out_q is not None:
+            self._put(out_q, _DONE)
+
+    def _verify_stage(self, in_q: queue.Queue, out_q: queue.Queue):
+        try:
+            finished = False
+            while not finished:
+                # collect paragraphs until there are enough new chunks for one batch
+                items, n_new = [], 0
+                while n_new < self.verify_batch_size:
+                    item = self._get(in_q)
+                    if item is _DONE:
+                        finished = True
+                        break
+                    items.append(item)
+                    n_new += len(item[2])
+                if self._stop.is_set():
+                    return
+                for result in self._verify(items):
+                    if not self._put(out_q, result):
+                        return
+        except BaseException as e:
+            self._fail(e)
+            return
+        self._put(out_q, _DONE)
+
+    def _verify(self, items: list[tuple]) -> list[tuple]:
+        """Verifies the new chunks of several paragraphs at once, and merges them with their reused chunks."""
+        texts = [chunks[i] for _, chunks, todo, _, _ in items for i in todo]
+        all_wavs = [wav for _, _, _, new_wavs, _ in items for wav in new_wavs]
+        all_metrics = iter(self.verify(texts, all_wavs) if texts else [])
+
+        results = []
+        for idx, chunks, todo, new_wavs, done in items:
+            wavs, metrics = [None] * len(chunks), [None] * len(chunks)
+            for i, (wav, m) in done.items():
+                wavs[i], metrics[i] = wav, m
+            for i, wav in zip(todo, new_wavs):
+                wavs[i], metrics[i] = wav, next(all_metrics)
+            results.append((idx, chunks, wavs, metrics))
+        return results
+
+    def _write(self, idx, chunks, wavs, metrics):
+        output = self.write(idx, chunks, wavs, metrics)
+        if self.manifest is not None and output is not None:
+            self.manifest.record(idx, chunks, [wav.shape[-1] for wav in wavs], output, metrics)
+
+    def run(self, chunks: Iterable[TextChunk]):
+        """
+        Renders the given normalized chunks, which must come in reading order. The chunks of a paragraph are
+        synthesized together. Returns once every paragraph has been written.
+        """
+        self._stop.clear()
+        self._errors = []
+        verify_q = queue.Queue(maxsize=self.queue_size)
+        write_q = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._verify_stage, args=(verify_q, write_q), name="verify", daemon=True),
+            threading.Thread(target=self._stage, args=(self._write, write_q, None), name="write", daemon=True),
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            for idx, group in itertools.groupby(chunks, key=lambda c: c.paragraph):
+                if self._stop.is_set():
+                    break
+                texts = [c.text for c in group]
+
+                # Reuse what a previous run already rendered
+                done = {}
+                if self.manifest is not None:
+                    entries = self.manifest.done_chunks(idx, texts)
+                    if len(entries) == len(texts):
+                        if self.on_skip is not None:
+                            self.on_skip(idx)
+                        continue
+                    done = {i: (RenderManifest.load_audio(e), e["metrics"]) for i, e in entries.items()}
+
+                todo = [i for i in range(len(texts)) if i not in done]
+                new_wavs = self.synthesize([texts[i] for i in todo])
+                if not self._put(verify_q, (idx, texts, todo, new_wavs, done)):
+                    break
+            self._put(verify_q, _DONE)
+            for t in threads:
+                t.join()
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            self._stop.set()
+            for t in threads:
+                t.join()
+
+        if self._errors:
+            raise self._errors[0]
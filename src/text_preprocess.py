@@ -1,28 +1,107 @@
 import os
 import logging
+import multiprocessing
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
 
-from nemo_text_processing.text_normalization.normalize import Normalizer
 import pysbd
 
+if TYPE_CHECKING:
+    from nemo_text_processing.text_normalization.normalize import Normalizer
+
+from .normalization_memo import NormalizationMemo
+
 logger = logging.getLogger(__name__)
 
+# Tokens the WFST normalizer may rewrite: digits, symbols, roman numerals and other all-caps tokens, and the
+# abbreviations of NeMo's English whitelist. Text without any of them is plain prose and passes through unchanged.
+_ABBREVIATIONS = (
+    "Mr", "Mrs", "Ms", "Dr", "Prof", "St", "Sr", "Jr", "Mt", "Ft", "Hon", "Rev", "Gen", "Col", "Capt", "Lt", "Sgt",
+    "Gov", "Sen", "Rep", "Pres", "Ave", "Blvd", "Rd", "Vol", "vs", "etc", "approx", "dept", "inc",
+    "ltd", "corp", "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+)
+_NEEDS_NORMALIZATION = re.compile(
+    r"[0-9$€£¥%&@#+=*/\\<>^_|~§°½¼¾©®™]"           # numbers, currency, measures and other symbols
+    r"|\b[A-Z]{2,}\b"                               # roman numerals and acronyms
+    r"|\b(?:[A-Za-z]\.){2,}"                         # dotted abbreviations (e.g., U.S.)
+    r"|(?i:\b(?:" + "|".join(_ABBREVIATIONS) + r")\.)"
+    r"|https?://|www\.|\.(?:com|org|net)\b"
+)
+
+# Per-process TextProcessor of the book normalization pool
+_worker_processor = None
+
+
+def _init_normalize_worker(input_case: str, lang: str, fast_path: bool, check_fast_path: bool,
+                           memo_path: Optional[str]):
+    global _worker_processor
+    _worker_processor = TextProcessor(input_case=input_case, lang=lang, fast_path=fast_path,
+                                      check_fast_path=check_fast_path, memo_path=memo_path)
+
+
+def _normalize_batch(texts: list[str], punct_post_process: bool) -> tuple[list[str], dict]:
+    # n_jobs=1: the pool already provides the parallelism
+    before = dict(_worker_processor.stats)
+    normalized = _worker_processor.normalize(texts, punct_post_process=punct_post_process, n_jobs=1)
+    return normalized, {k: v - before[k] for k, v in _worker_processor.stats.items()}
+
+
+@dataclass
+class TextChunk:
+    """A chunk of a book, addressed by its paragraph index and its index within the paragraph."""
+    paragraph: int
+    chunk: int
+    text: str
+
 
 class TextProcessor:
     """
     A class for text processing using NeMo's Normalizer.
     """
 
-    def __init__(self, input_case: str = 'cased', lang: str = 'en'):
+    def __init__(self, input_case: str = 'cased', lang: str = 'en', fast_path: bool = True,
+                 check_fast_path: bool = False, memo_path: Optional[str] = None):
         """
         Initializes the TextProcessor with a Normalizer instance.
 
         Args:
             input_case (str): The input case for the normalizer. Defaults to 'cased'.
             lang (str): The language for the normalizer. Defaults to 'en'.
+            fast_path (bool): Skip the normalizer for plain prose, i.e. text without any normalizable token.
+                Only applies to English.
+            check_fast_path (bool): Still normalize the skipped text and count (and log) where the result differs.
+            memo_path (Optional[str]): Path of a `NormalizationMemo` database, so that text normalized by an
+                earlier run (of any book) is not normalized again. If None, nothing is memoized.
         """
-        self.normalizer = Normalizer(input_case=input_case, lang=lang)
+        self.input_case = input_case
+        self.lang = lang
+        self.fast_path = fast_path and lang == 'en'
+        self.check_fast_path = check_fast_path
+        self.memo_path = memo_path
+        self.memo = NormalizationMemo(memo_path, input_case=input_case, lang=lang) if memo_path is not None else None
         self.segmenter = pysbd.Segmenter(language=lang, clean=False)
+        self.stats = dict(chunks=0, bypassed=0, mismatches=0, memo_hits=0)
+
+    @property
+    def bypass_rate(self) -> float:
+        """Share of the normalized chunks that skipped the normalizer."""
+        return self.stats["bypassed"] / self.stats["chunks"] if self.stats["chunks"] else 0.0
+
+    @staticmethod
+    def needs_normalization(text: str) -> bool:
+        """Whether the text contains a token the normalizer may rewrite (numbers, symbols, abbreviations...)."""
+        return _NEEDS_NORMALIZATION.search(text) is not None
+
+    @property
+    def normalizer(self) -> "Normalizer":
+        # Importing NeMo and building the grammars takes a while, and splitting alone does not need them
+        if not hasattr(self, "_normalizer"):
+            from nemo_text_processing.text_normalization.normalize import Normalizer
+            self._normalizer = Normalizer(input_case=self.input_case, lang=self.lang)
+        return self._normalizer
 
     def normalize(self, text: str | list[str], punct_post_process: bool = False, n_jobs: int = -2, batch_size: int = 100) -> str | list[str]:
         """
@@ -33,21 +112,165 @@ class TextProcessor:
             punct_post_process (bool): Whether to apply post-processing on punctuation.
 
         Returns:
-            The normalized text.
+            The normalized text. With `fast_path`, plain prose is returned as is.
         """
+        texts = [text] if isinstance(text, str) else list(text)
+        todo = [i for i, t in enumerate(texts) if not self.fast_path or self.needs_normalization(t)]
+        self.stats["chunks"] += len(texts)
+        self.stats["bypassed"] += len(texts) - len(todo)
+
         # Using the normalizer's normalize function
-        if isinstance(text, str):
-            return self.normalizer.normalize(text, punct_post_process=punct_post_process)
+        if self.check_fast_path:
+            checked = self._normalize(texts, punct_post_process, n_jobs, batch_size)
+            todo_set = set(todo)
+            for i, (t, n) in enumerate(zip(texts, checked)):
+                if i not in todo_set and n != t:
+                    self.stats["mismatches"] += 1
+                    logger.warning(f"Fast path differs from the normalizer: {t!r} -> {n!r}")
+            normalized = checked
         else:
-            return self.normalizer.normalize_list(text, punct_post_process=punct_post_process, n_jobs=n_jobs, batch_size=batch_size)
+            normalized = list(texts)
+            if todo:
+                for i, n in zip(todo, self._normalize([texts[i] for i in todo], punct_post_process, n_jobs, batch_size)):
+                    normalized[i] = n
+
+        return normalized[0] if isinstance(text, str) else normalized
+
+    def _normalize(self, texts: list[str], punct_post_process: bool, n_jobs: int, batch_size: int) -> list[str]:
+        if self.memo is None:
+            return self._run_normalizer(texts, punct_post_process, n_jobs, batch_size)
+
+        normalized = self.memo.get_many(texts, punct_post_process)
+        missing = [i for i, n in enumerate(normalized) if n is None]
+        self.stats["memo_hits"] += len(texts) - len(missing)
+        if missing:
+            new = self._run_normalizer([texts[i] for i in missing], punct_post_process, n_jobs, batch_size)
+            self.memo.put_many([texts[i] for i in missing], new, punct_post_process)
+            for i, n in zip(missing, new):
+                normalized[i] = n
+        return normalized
+
+    def _run_normalizer(self, texts: list[str], punct_post_process: bool, n_jobs: int, batch_size: int) -> list[str]:
+        if len(texts) == 1:
+            return [self.normalizer.normalize(texts[0], punct_post_process=punct_post_process)]
+        return self.normalizer.normalize_list(texts, punct_post_process=punct_post_process, n_jobs=n_jobs, batch_size=batch_size)
+
+    def split_book(self, text: str, max_len: int = 1000, length_fn: Callable[[str], int] = len) -> list[TextChunk]:
+        """
+        Splits a whole book into paragraphs, and the paragraphs into chunks of at most max_len.
+
+        Args:
+            text (str): The text of the book.
+            max_len (int): The maximum length per chunk, as measured by `length_fn`.
+            length_fn: Length of a piece of text, in characters by default. See `sentence_splitter`.
+
+        Returns:
+            list[TextChunk]: The chunks in reading order. Paragraph indices follow `paragraph_splitter`.
+        """
+        return [
+            TextChunk(p_idx, c_idx, chunk)
+            for p_idx, paragraph in enumerate(self.paragraph_splitter(text))
+            for c_idx, chunk in enumerate(self.sentence_splitter(paragraph, max_len=max_len, length_fn=length_fn))
+        ]
+
+    def iter_normalized_book(self, text: str, max_len: int = 1000, length_fn: Callable[[str], int] = len,
+                             n_workers: int = 2, batch_size: int = 64, prefetch: int = 4,
+                             punct_post_process: bool = False) -> Iterator[TextChunk]:
+        """
+        Splits and normalizes a whole book, yielding the normalized chunks in reading order.
+
+        Sentences are normalized first, and a paragraph is packed into chunks once all of its sentences are back,
+        so that `max_len` holds for the text the model actually receives: normalization expands numbers, dates
+        and abbreviations, sometimes to several times their written length.
+
+        All sentences go through one process pool that lives for the whole book, in batches of `batch_size`
+        sentences regardless of paragraph boundaries, instead of starting a joblib pool per paragraph. At most
+        `prefetch` batches are in flight, so the first chunks are available long before the book is normalized.
+
+        Args:
+            text (str): The text of the book.
+            max_len (int): The maximum length per normalized chunk, as measured by `length_fn`.
+            length_fn: Length of a piece of text, in characters by default. See `sentence_splitter`.
+            n_workers (int): Number of normalization processes.
+            batch_size (int): Number of sentences per task.
+            prefetch (int): Number of batches in flight.
+            punct_post_process (bool): Whether to apply post-processing on punctuation.
+
+        Yields:
+            TextChunk: The normalized chunks.
+        """
+        if max_len <= 0:
+            raise ValueError("max_len must be positive")
+        # (paragraph index, sentence), paragraph indices follow `paragraph_splitter`
+        sentences = [
+            (p_idx, sentence.strip())
+            for p_idx, paragraph in enumerate(self.paragraph_splitter(text))
+            for sentence in self.segmenter.segment(paragraph)
+            if sentence.strip()
+        ]
+        batches = [sentences[i:i + batch_size] for i in range(0, len(sentences), batch_size)]
 
-    def sentence_splitter(self, text: str, max_chars: int = 1000) -> list[str]:
+        # spawn: the parent may already hold CUDA / OpenMP state that does not survive a fork
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_normalize_worker,
+            initargs=(self.input_case, self.lang, self.fast_path, self.check_fast_path, self.memo_path),
+        )
+
+        # normalized sentences of the paragraph that is still being collected
+        current = dict(paragraph=None, sentences=[])
+
+        def pack():
+            chunks = self._pack_sentences(current["sentences"], max_len, length_fn)
+            return [TextChunk(current["paragraph"], c_idx, chunk) for c_idx, chunk in enumerate(chunks)]
+
+        def collect(batch, future):
+            normalized, stats = future.result()
+            for k, v in stats.items():
+                self.stats[k] += v
+            ready = []
+            for (p_idx, _), sentence in zip(batch, normalized):
+                if p_idx != current["paragraph"]:
+                    if current["sentences"]:
+                        ready += pack()
+                    current.update(paragraph=p_idx, sentences=[])
+                current["sentences"].append(sentence)
+            return ready
+
+        try:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, pool.submit(_normalize_batch, [s for _, s in batch], punct_post_process)))
+                if len(pending) >= prefetch:
+                    yield from collect(*pending.popleft())
+            while pending:
+                yield from collect(*pending.popleft())
+            if current["sentences"]:
+                yield from pack()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            logger.info(f"Normalization: {self.stats['bypassed']}/{self.stats['chunks']} sentences bypassed the "
+                        f"normalizer ({self.bypass_rate:.0%})")
+
+    def normalize_book(self, text: str, max_len: int = 1000, **kwargs) -> list[TextChunk]:
+        """
+        Splits and normalizes a whole book. See `iter_normalized_book` for the arguments.
         """
-        Split text into chunks, where each chunk is as close to max_chars as possible.
+        return list(self.iter_normalized_book(text, max_len=max_len, **kwargs))
+
+    def sentence_splitter(self, text: str, max_len: int = 1000, length_fn: Callable[[str], int] = len) -> list[str]:
+        """
+        Split text into chunks, where each chunk is as close to max_len as possible.
+
+        With a token count as `length_fn` (e.g. `TextToSpeech.count_text_tokens`), chunks are packed against the
+        model's token budget rather than by characters. Lengths are summed per sentence, so `length_fn` should be
+        roughly additive.
         
         Args:
             text: The text to split
-            max_chars: The maximum number of characters per chunk
+            max_len: The maximum length per chunk, in characters unless `length_fn` says otherwise
+            length_fn: Length of a piece of text
         
         Returns:
             A list of text chunks
@@ -55,50 +278,57 @@ class TextProcessor:
         # Edge cases
         if not text:
             return []
-        if max_chars <= 0:
-            raise ValueError("max_chars must be positive")
+        if max_len <= 0:
+            raise ValueError("max_len must be positive")
         
         # Use sentencex to get all sentences
-        sentences = list(self.segmenter.segment(text))
-        
+        return self._pack_sentences(list(self.segmenter.segment(text)), max_len, length_fn)
+
+    def _pack_sentences(self, sentences: list[str], max_len: int, length_fn: Callable[[str], int]) -> list[str]:
         chunks = []
         current_chunk = ""
+        current_len = 0
+        space_len = length_fn(" ")
         
         for sentence in sentences:
+            sentence_len = length_fn(sentence)
             # Add a space between sentences if current_chunk is not empty
             space = " " if current_chunk else ""
-            # Check if adding the sentence would exceed max_chars
-            if len(current_chunk) + len(space) + len(sentence) <= max_chars:
+            # Check if adding the sentence would exceed max_len
+            if current_len + (space_len if space else 0) + sentence_len <= max_len:
                 current_chunk += space + sentence
-            # If the sentence itself is longer than max_chars, split it
-            elif len(sentence) > max_chars:
+                current_len += (space_len if space else 0) + sentence_len
+            # If the sentence itself is longer than max_len, split it
+            elif sentence_len > max_len:
                 # Add the current chunk if it's not empty
                 if current_chunk:
                     chunks.append(current_chunk)
                     current_chunk = ""
                 
                 # Split the long sentence
-                sentence_chunks = self.split_long_sentence(sentence, max_chars)
+                sentence_chunks = self._split_long_sentence_by_length(sentence, max_len, length_fn)
                 
                 # Add all chunks except the last one
                 chunks.extend(sentence_chunks[:-1])
                 
                 # Start a new chunk with the last sentence chunk
                 current_chunk = sentence_chunks[-1]
+                current_len = length_fn(current_chunk)
             # Otherwise, start a new chunk with this sentence
             else:
                 if current_chunk:
                     chunks.append(current_chunk)
                 current_chunk = sentence
+                current_len = sentence_len
         
         # Add the last chunk if it's not empty
         if current_chunk:
             chunks.append(current_chunk)
         
         # For DEBUG only
-        # # Assert that no chunk exceeds max_chars
+        # # Assert that no chunk exceeds max_len
         # for i, chunk in enumerate(chunks):
-        #     assert len(chunk) <= max_chars, f"Chunk {i} length {len(chunk)} exceeds max_chars {max_chars}"
+        #     assert len(chunk) <= max_len, f"Chunk {i} length {len(chunk)} exceeds max_len {max_len}"
         
         # # Assert that no content is lost (loose check)
         # original_sans_whitespace = ''.join(c for c in text if not c.isspace())
@@ -109,7 +339,8 @@ class TextProcessor:
         
         return chunks
 
-    def paragraph_splitter(self, text: str) -> list[str]:
+    @staticmethod
+    def paragraph_splitter(text: str) -> list[str]:
         """
         Splits text into paragraphs based on one or more empty lines.
 
@@ -124,6 +355,17 @@ class TextProcessor:
         # Filter out any empty strings that may result from the split
         return [p.strip() for p in paragraphs if p.strip()]
 
+    def _split_long_sentence_by_length(self, sentence: str, max_len: int, length_fn: Callable[[str], int]) -> list[str]:
+        if length_fn is len:
+            return self.split_long_sentence(sentence, max_len)
+        # Convert the budget to characters at the sentence's own density, and tighten it until every part fits
+        max_chars = max(1, int(max_len * len(sentence) / max(length_fn(sentence), 1)))
+        while True:
+            parts = self.split_long_sentence(sentence, max_chars)
+            if max_chars == 1 or all(length_fn(p) <= max_len for p in parts):
+                return parts
+            max_chars = max(1, int(max_chars * 0.9))
+
     def split_long_sentence(self, sentence: str, max_chars: int) -> list[str]:
         """
         Split a long sentence into smaller parts based on punctuation and spaces.
@@ -1,14 +1,17 @@
-from src.chatterbox.tts import ChatterboxTTS
+from src.audio_cache import AudioCache
+from src.chatterbox.models.t3.modules.cond_enc import T3Cond
+from src.chatterbox.models.t3.inference.sampler import chunk_seed
+from src.chatterbox.tts import ChatterboxTTS, punc_norm
+from src.voice_library import VoiceLibrary
 import torch
 import torchaudio
+import time
 
 from typing import Optional
-import whisper
 import difflib
 import re
 import string
 import traceback as tb
-from whisper.normalizers import EnglishTextNormalizer
 
 def _t3_to(model: "ChatterboxTTS", dtype):
     model.t3.to(dtype=dtype)
@@ -30,13 +33,21 @@ class TextToSpeech:
     A class for performing Text-to-Speech using ChatterboxTTS.
     """
 
-    def __init__(self, device: Optional[str] = None):
+    def __init__(self, device: Optional[str] = None, cache_path: Optional[str] = None, cache_max_bytes: int = 2 << 30,
+        voice_library_path: Optional[str] = None, stt_model_name: Optional[str] = "base.en"):
         """
         Initializes the TextToSpeech class and loads the ChatterboxTTS model.
 
         Args:
             device (Optional[str]): The device to use for inference (e.g., "cuda", "mps", "cpu").
                                     If None, the best available device will be automatically detected.
+            cache_path (Optional[str]): Path of an `AudioCache` database for already synthesized chunks.
+                                    If None, nothing is cached.
+            cache_max_bytes (int): Size cap of the audio cache.
+            voice_library_path (Optional[str]): Directory of a `VoiceLibrary` of prepared voice conditionals.
+                                    If None, the conditionals are prepared from the reference audio every time.
+            stt_model_name (Optional[str]): Whisper model of `check_tts`. It is only imported and loaded on the
+                                    first check. If None, `check_tts` is disabled, e.g. for synthesis-only workers.
         """
         if device is None:
             if torch.cuda.is_available():
@@ -48,45 +59,176 @@ class TextToSpeech:
         else:
             self.device = device
         print(f"Using device: {self.device}")
-        self.model = ChatterboxTTS.from_pretrained(device=self.device)
+        # T3 is cast to bfloat16 while its weights are loaded; _t3_to then only converts the conditionals
+        self.model = ChatterboxTTS.from_pretrained(device=self.device, t3_dtype=torch.bfloat16)
         #ei debug
         _t3_to(self.model, torch.bfloat16)
         self.model = _compile_t3(self.model)
-        self.stt_model = whisper.load_model("base.en", device=self.device)
-        self.stt_options = whisper.DecodingOptions(language="en", without_timestamps=True)
+        print("Cold start: " + ", ".join(f"{k} {v:.2f}s" for k, v in self.model.load_stats.items()))
+        self.stt_model_name = stt_model_name
         self.resampler = torchaudio.transforms.Resample(24_000, 16_000)
-        self.normalizer = EnglishTextNormalizer()
+        # clips, Whisper windows and ambiguous clips decoded again on their own, of `check_tts_packed`
+        self.pack_stats = dict(clips=0, windows=0, fallbacks=0)
+        self.cache = AudioCache(cache_path, max_bytes=cache_max_bytes) if cache_path is not None else None
+        self.voices = VoiceLibrary(voice_library_path, self.model.checksum) if voice_library_path is not None else None
+
+    @property
+    def stt_model(self):
+        """The Whisper model of `check_tts`, imported and loaded on first use."""
+        if not hasattr(self, "_stt_model"):
+            assert self.stt_model_name is not None, "Speech-to-text checks are disabled (stt_model_name=None)"
+            import whisper
+            from whisper.normalizers import EnglishTextNormalizer
+            start = time.perf_counter()
+            self._stt_model = whisper.load_model(self.stt_model_name, device=self.device)
+            self.stt_options = whisper.DecodingOptions(language="en", without_timestamps=True)
+            self.stt_timestamp_options = whisper.DecodingOptions(language="en", without_timestamps=False)
+            self.stt_tokenizer = whisper.tokenizer.get_tokenizer(self._stt_model.is_multilingual, language="en",
+                                                                 task="transcribe")
+            self.normalizer = EnglishTextNormalizer()
+            print(f"Loaded Whisper {self.stt_model_name} in {time.perf_counter() - start:.2f}s")
+        return self._stt_model
 
     def prepare_conditionals(self, audio_prompt_path: str, exaggeration:float=0.5):
         """
         Prepares the conditionals for the TTS model.
 
         Args:
-            audio_prompt_path (str): Path to an audio file to use as a voice prompt.
+            audio_prompt_path (str): Path to an audio file to use as a voice prompt, or the name of a profile in the
+                voice library. Profiles are loaded from the voice library, and new clips are added to it.
         """
-        self.model.prepare_conditionals(audio_prompt_path, exaggeration)
+        if self.voices is None:
+            self.model.prepare_conditionals(audio_prompt_path, exaggeration)
+            return
+
+        conds = self.voices.load(audio_prompt_path, device=self.device)
+        if conds is None:
+            self.model.prepare_conditionals(audio_prompt_path, exaggeration)
+            self.voices.add(audio_prompt_path, self.model.conds)
+            return
+        conds.t3 = T3Cond(
+            speaker_emb=conds.t3.speaker_emb,
+            cond_prompt_speech_tokens=conds.t3.cond_prompt_speech_tokens,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=self.device)
+        self.model.conds = conds
 
     def generate_speech(self, text: str | list[str], audio_prompt_path: Optional[str] = None, exaggeration: float = 0.5,
-        cfg_weight: float =0.5, temperature: float =0.8, repetition_penalty: float =1.0):
+        cfg_weight: float =0.5, temperature: float =0.8, repetition_penalty: float =1.0, seed: Optional[int] = None,
+        ref_crop: Optional[int | str] = None, cfm_steps: int = 10, cfm_solver: str = "euler",
+        cfm_schedule: Optional[str] = None, alignment_stop: Optional[bool | tuple] = None,
+        cfg_steps: Optional[int] = None, cfg_interval: int = 1, s3gen_batch_size: int = 1):
         """
         Generates speech from the given text.
 
         Args:
-            text (str): The text to synthesize.
+            text (str | list[str]): The text to synthesize. A list of chunks is synthesized as one batch.
             audio_prompt_path (Optional[str]): Path to an audio file to use as a voice prompt.
+            seed (Optional[int]): Seed of the sampler. Each chunk gets its own stream derived from it and its text,
+                so its audio does not depend on the other chunks of the batch. Also part of the cache key.
+            ref_crop (Optional[int | str]): Number of reference tokens (25 per second) used as S3Gen prompt, "auto"
+                to scale it with each chunk, or None for the full reference.
+            cfm_steps (int), cfm_solver (str), cfm_schedule (Optional[str]): ODE integration of the S3Gen decoder.
+                E.g. 4 "multistep" steps for draft renders. See `ConditionalCFM.solve`.
+            alignment_stop (Optional[bool | tuple]): Stop runaway chunks (long tails, repetitions) early, see
+                `T3.inference_stream`. Per-chunk outcomes are in `self.model.t3.last_alignment_stats`.
+            cfg_steps (Optional[int]), cfg_interval (int): CFG schedule of T3: guide only the first `cfg_steps`
+                speech tokens, and / or refresh the unconditional logits every `cfg_interval` tokens. Cheaper
+                decoding, see `benchmarks/cfg_schedules.py` for the intelligibility cost.
+            s3gen_batch_size (int): Number of chunks S3Gen renders at once. Faster for lists of chunks, but the
+                audio differs slightly from unbatched rendering (HiFT vocodes padded mels).
 
         Returns:
-            torch.Tensor: The generated audio waveform.
+            torch.Tensor | list[torch.Tensor]: The generated audio waveform, or one waveform per chunk for list input.
         """
+        texts = [text] if isinstance(text, str) else list(text)
+        gen_kwargs = dict(exaggeration=exaggeration, cfg_weight=cfg_weight, temperature=temperature,
+            repetition_penalty=repetition_penalty, ref_crop=ref_crop, cfm_steps=cfm_steps, cfm_solver=cfm_solver,
+            cfm_schedule=cfm_schedule, alignment_stop=alignment_stop, cfg_steps=cfg_steps, cfg_interval=cfg_interval,
+            s3gen_batch_size=s3gen_batch_size)
+
+        if self.cache is None:
+            wavs = self._generate(texts, audio_prompt_path, seed, gen_kwargs)
+        else:
+            if audio_prompt_path:
+                # the voice has to be known before the cache lookup
+                self.prepare_conditionals(audio_prompt_path, exaggeration)
+            params = dict(gen_kwargs, seed=seed, voice=self.model.conds.checksum(), model=self.model.checksum,
+                dtype=str(next(self.model.t3.parameters()).dtype))
+            keys = [AudioCache.key(punc_norm(t), **params) for t in texts]
+            wavs = [self.cache.get(k) for k in keys]
+            missing = [i for i, wav in enumerate(wavs) if wav is None]
+            if missing:
+                new_wavs = self._generate([texts[i] for i in missing], None, seed, gen_kwargs)
+                for i, wav in zip(missing, new_wavs):
+                    self.cache.put(keys[i], wav)
+                    wavs[i] = wav
+
+        if isinstance(text, str):
+            return torch.cat(wavs)
+        return wavs
+
+    def _generate(self, texts: list[str], audio_prompt_path: Optional[str], seed: Optional[int], gen_kwargs: dict):
+        seeds = None
+        if seed is not None:
+            torch.manual_seed(seed)
+            # per chunk, so that a cached chunk sounds the same as when it is synthesized in another batch
+            seeds = [chunk_seed(seed, punc_norm(t)) for t in texts]
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, gen_kwargs["exaggeration"])
         with torch.no_grad():
-            chunk_generator = self.model.generate(text, audio_prompt_path=audio_prompt_path, 
-                exaggeration=exaggeration, cfg_weight=cfg_weight, temperature=temperature, repetition_penalty=repetition_penalty)
-            out = torch.cat(list(chunk_generator)).detach().cpu()
+            chunk_generator = self.model.generate(texts, seeds=seeds, **gen_kwargs)
+            wavs = [wav.detach().cpu() for wav in chunk_generator]
             # print(next(chunk_generator).shape)
-        torch.cuda.synchronize()
-        return out
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return wavs
+
+    def stream_speech(self, text: str, tokens_per_slice: int = 25, audio_prompt_path: Optional[str] = None,
+        exaggeration: float = 0.5, cfg_weight: float = 0.5, temperature: float = 0.8, repetition_penalty: float = 1.0):
+        """
+        Generates speech from the given text, yielding audio while it is being synthesized.
+
+        Args:
+            text (str): The text to synthesize.
+            tokens_per_slice (int): Number of speech tokens (25 per second of audio) per yielded chunk.
+            audio_prompt_path (Optional[str]): Path to an audio file to use as a voice prompt.
+
+        Yields:
+            torch.Tensor: Consecutive chunks of the audio waveform. Timings, including the time to first audio,
+            are available in `self.model.stream_stats` once the stream is exhausted.
+        """
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, exaggeration)
+        with torch.no_grad():
+            yield from self.model.generate(text, tokens_per_slice=tokens_per_slice,
+                exaggeration=exaggeration, cfg_weight=cfg_weight, temperature=temperature, repetition_penalty=repetition_penalty)
+
+    def count_text_tokens(self, text: str) -> int:
+        """
+        Number of T3 text tokens of the given text. Use as `length_fn` of `TextProcessor` to pack chunks by tokens.
+        """
+        return self.model.count_text_tokens(text)
+
+    def measure_speech_rate(self, texts: list[str], **kwargs) -> float:
+        """
+        Measures the speech tokens per text token of the current voice on sample `texts`, which
+        `text_token_budget` then relies on. See `ChatterboxTTS.measure_speech_rate` for the arguments.
+        """
+        with torch.no_grad():
+            return self.model.measure_speech_rate(texts, **kwargs)
+
+    def text_token_budget(self, **kwargs) -> int:
+        """
+        Maximum number of text tokens per chunk that fits the T3 cache and `max_new_tokens`.
+        See `ChatterboxTTS.text_token_budget` for the arguments.
+        """
+        return self.model.text_token_budget(**kwargs)
 
     def check_tts(self, target_text: str, wav: torch.Tensor):
+        return self.check_tts_batch([target_text], [wav])[0]
+
+    def _similarity(self, transcribed: str, target_text: str) -> float:
 
         def normalize_for_compare_all_punct(text):
             text = re.sub(r'[–—-]', ' ', text)
@@ -94,24 +236,138 @@ class TextToSpeech:
             text = re.sub(r'\s+', ' ', text)
             return text.lower().strip()
 
-        try:
-            audio = self.resampler(wav)
-            audio = whisper.pad_or_trim(audio)
-            mel = whisper.log_mel_spectrogram(audio.squeeze(0).to(self.device))
-            result = self.stt_model.decode(mel, self.stt_options)
-            # print(result)
-            transcribed = self.normalizer(result.text.strip().lower())
-            target_text = self.normalizer(target_text.strip().lower())
-            # print(f"\033[32m[DEBUG] Whisper transcription: '\033[33m{transcribed}'\033[0m")
-            score = difflib.SequenceMatcher(
-                None,
-                normalize_for_compare_all_punct(transcribed),
-                normalize_for_compare_all_punct(target_text)
-            ).ratio()
-            # print(f"\033[32m[DEBUG] Score: {score:.3f} (target: '\033[33m{target_text}')\033[0m")
-            return (score)
-        except Exception as e:
-            tb.print_exc()
-            print(f"[ERROR] Whisper transcription failed for {target_text}: {e}")
-            return (0.0)
+        transcribed = self.normalizer(transcribed.strip().lower())
+        target_text = self.normalizer(target_text.strip().lower())
+        return difflib.SequenceMatcher(
+            None,
+            normalize_for_compare_all_punct(transcribed),
+            normalize_for_compare_all_punct(target_text)
+        ).ratio()
+
+    def check_tts_batch(self, target_texts: list[str], wavs: list[torch.Tensor], batch_size: int = 16) -> list[float]:
+        """
+        Similarity between each target text and the Whisper transcription of its waveform. The clips are padded
+        to Whisper's 30 s window and decoded `batch_size` at a time as one batch of mels.
+        """
+        import whisper
+        stt_model = self.stt_model
+        scores = []
+        for start in range(0, len(wavs), batch_size):
+            texts = target_texts[start:start + batch_size]
+            try:
+                mels = []
+                for wav in wavs[start:start + batch_size]:
+                    audio = whisper.pad_or_trim(self.resampler(wav))
+                    mels.append(whisper.log_mel_spectrogram(audio.squeeze(0).to(self.device)))
+                results = whisper.decode(stt_model, torch.stack(mels), self.stt_options)
+            except Exception as e:
+                tb.print_exc()
+                print(f"[ERROR] Whisper transcription failed for {texts}: {e}")
+                scores += [0.0] * len(texts)
+                continue
+            scores += [self._similarity(result.text, text) for result, text in zip(results, texts)]
+        return scores
+
+    def _timestamped_segments(self, tokens: list[int]) -> list[tuple[float, Optional[float], str]]:
+        """(start s, end s or None if open, text) of the segments of a Whisper decoding with timestamps."""
+        timestamp_begin = self.stt_tokenizer.timestamp_begin
+        segments, start, text = [], 0.0, []
+        for token in tokens:
+            if token < timestamp_begin:
+                if token < self.stt_tokenizer.eot:
+                    text.append(token)
+                continue
+            t = (token - timestamp_begin) * 0.02
+            if text:
+                segments.append((start, t, self.stt_tokenizer.decode(text)))
+                text = []
+            start = t
+        if text:
+            segments.append((start, None, self.stt_tokenizer.decode(text)))
+        return segments
+
+    def check_tts_packed(self, target_texts: list[str], wavs: list[torch.Tensor], gap_s: float = 1.0,
+                         batch_size: int = 16, min_overlap_s: float = 0.25) -> list[float]:
+        """
+        Like `check_tts_batch`, but several short clips share one 30 s Whisper window, separated by `gap_s` of
+        silence. Every window is transcribed once with timestamps, and each timestamped segment is assigned to
+        the clip it falls on. Clips whose transcript is ambiguous (a segment overlapping two clips by more than
+        `min_overlap_s`, no timestamps or an empty transcript) are decoded on their own instead.
+        """
+        import whisper
+        stt_model = self.stt_model
+        sr, window = whisper.audio.SAMPLE_RATE, whisper.audio.N_SAMPLES
+        gap = int(gap_s * sr)
+        audios = [self.resampler(wav).reshape(-1) for wav in wavs]
+
+        # greedily fill windows in order: [(clip indices, [(start, end) sample spans])]
+        windows = []
+        for i, audio in enumerate(audios):
+            if windows and windows[-1][1][-1][1] + gap + len(audio) <= window:
+                offset = windows[-1][1][-1][1] + gap
+                windows[-1][0].append(i)
+                windows[-1][1].append((offset, offset + len(audio)))
+            else:
+                windows.append(([i], [(0, len(audio))]))
+
+        transcripts, fallback = [[] for _ in wavs], set()
+        packed = [w for w in windows if len(w[0]) > 1]
+        single = {w[0][0] for w in windows if len(w[0]) == 1}
+        for start in range(0, len(packed), batch_size):
+            batch = packed[start:start + batch_size]
+            try:
+                mels = []
+                for indices, spans in batch:
+                    audio = torch.zeros(window)
+                    for i, (a, b) in zip(indices, spans):
+                        audio[a:b] = audios[i].cpu()
+                    mels.append(whisper.log_mel_spectrogram(audio.to(self.device)))
+                results = whisper.decode(stt_model, torch.stack(mels), self.stt_timestamp_options)
+            except Exception as e:
+                tb.print_exc()
+                print(f"[ERROR] Whisper transcription failed for a packed window: {e}")
+                fallback.update(i for indices, _ in batch for i in indices)
+                continue
+
+            for (indices, spans), result in zip(batch, results):
+                # every clip owns the audio up to the middle of the gaps around it
+                bounds = [0.0] + [(spans[k][1] + spans[k + 1][0]) / 2 / sr for k in range(len(spans) - 1)]
+                bounds.append(window / sr)
+                segments = self._timestamped_segments(result.tokens)
+                if not segments or all(end is None for _, end, _ in segments):
+                    fallback.update(indices)
+                    continue
+                for seg_start, seg_end, text in segments:
+                    seg_end = bounds[-1] if seg_end is None else seg_end
+                    owners = [k for k in range(len(indices))
+                              if min(seg_end, bounds[k + 1]) - max(seg_start, bounds[k]) > min_overlap_s]
+                    if not owners:
+                        middle = (seg_start + seg_end) / 2
+                        owners = [k for k in range(len(indices)) if bounds[k] <= middle < bounds[k + 1]][:1]
+                    if len(owners) > 1:
+                        fallback.update(indices[k] for k in owners)
+                    for k in owners:
+                        transcripts[indices[k]].append(text)
+
+        scores = [None] * len(wavs)
+        for i, parts in enumerate(transcripts):
+            if i in single or i in fallback:
+                continue
+            if not "".join(parts).strip():
+                fallback.add(i)
+                continue
+            scores[i] = self._similarity(" ".join(parts), target_texts[i])
+
+        # clips that did not share a window (too long, or the last one) are decoded on their own anyway
+        unpacked = sorted(single | fallback)
+        if unpacked:
+            unpacked_scores = self.check_tts_batch([target_texts[i] for i in unpacked], [wavs[i] for i in unpacked],
+                                                   batch_size)
+            for i, score in zip(unpacked, unpacked_scores):
+                scores[i] = score
+
+        self.pack_stats["clips"] += len(wavs)
+        self.pack_stats["windows"] += len(packed) + len(single)
+        self.pack_stats["fallbacks"] += len(fallback)
+        return scores
 
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from src.chatterbox.tts import Conditionals
+
+logger = logging.getLogger(__name__)
+
+
+class VoiceLibrary:
+    """
+    A directory of prepared voice conditionals, so that switching voices, or many workers loading the same voice,
+    costs a file read instead of the voice encoder, S3 tokenizer, CAMPPlus and mel forwards of
+    `ChatterboxTTS.prepare_conditionals`.
+
+    A profile holds all T3 and S3Gen conditionals of one reference clip in a safetensors file, which is
+    memory-mapped on load and read tensor by tensor straight to the target device. It is keyed by a hash of the reference audio file and the model checksum, so an edited
+    clip or a different checkpoint gets a new profile instead of stale conditionals. Every profile also has a
+    name (by default the file name of the clip) to load it without the clip.
+    """
+
+    def __init__(self, root: str, model_checksum: str):
+        """
+        Args:
+            root (str): Directory of the profiles. Created if missing.
+            model_checksum (str): `ChatterboxTTS.checksum` of the loaded model. Only its profiles are used.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.model_checksum = model_checksum
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def audio_hash(wav_fpath: str) -> str:
+        """Hash of the contents of a reference audio file."""
+        h = hashlib.sha1()
+        with open(wav_fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _path(self, audio_hash: str) -> Path:
+        return self.root / f"{audio_hash}-{self.model_checksum[:16]}.safetensors"
+
+    @staticmethod
+    def _read_profile(fpath: Path) -> Optional[dict]:
+        """The profile stored in `fpath`, from its file header only, or None if it cannot be read."""
+        try:
+            with safe_open(str(fpath), framework="pt") as f:
+                metadata = f.metadata() or {}
+        except Exception as e:
+            logger.warning(f"Skipping unreadable voice profile {fpath}: {e}")
+            return None
+        return dict(metadata, created=float(metadata.get("created", 0)), path=str(fpath))
+
+    def list(self, all_models: bool = False) -> list[dict]:
+        """
+        Returns the profiles of the current model (or of every model with `all_models`), as dicts with name,
+        source, audio_hash, model, voice (`Conditionals.checksum`, missing in older profiles), created and path.
+        Only the file headers are read.
+        """
+        profiles = []
+        for fpath in sorted(self.root.glob("*.safetensors")):
+            profile = self._read_profile(fpath)
+            if profile is None or (not all_models and profile.get("model") != self.model_checksum):
+                continue
+            profiles.append(profile)
+        return profiles
+
+    def find(self, voice: str) -> Optional[dict]:
+        """The profile of `voice`, either a reference audio file or the name of a profile of the current model."""
+        if os.path.isfile(voice):
+            # the path of its profile follows from the clip, so only that header is read
+            path = self._path(self.audio_hash(voice))
+            profile = self._read_profile(path) if path.is_file() else None
+            if profile is None or profile.get("model") != self.model_checksum:
+                return None
+            return profile
+        return next((p for p in self.list() if p["name"] == voice), None)
+
+    def add(self, wav_fpath: str, conds: Conditionals, name: Optional[str] = None) -> dict:
+        """
+        Stores the conditionals prepared from `wav_fpath`, replacing any profile of the same clip. Returns the
+        profile.
+        """
+        audio_hash = self.audio_hash(wav_fpath)
+        metadata = dict(
+            name=name or Path(wav_fpath).stem,
+            source=str(wav_fpath),
+            audio_hash=audio_hash,
+            model=self.model_checksum,
+            voice=conds.checksum(),
+            created=str(time.time()),
+        )
+        path = self._path(audio_hash)
+        # write and rename, so that concurrent readers never see a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        save_file(conds.to_tensors(), str(tmp_path), metadata=metadata)
+        os.replace(tmp_path, path)
+        return dict(metadata, created=float(metadata["created"]), path=str(path))
+
+    def load(self, voice: str, device="cpu") -> Optional[Conditionals]:
+        """
+        The conditionals of `voice` (a reference audio file or a profile name) on `device`, or None if there is no
+        profile for it.
+        """
+        profile = self.find(voice)
+        if profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with safe_open(profile["path"], framework="pt", device=str(device)) as f:
+            tensors = {k: f.get_tensor(k) for k in f.keys()}
+        conds = Conditionals.from_tensors(tensors).to(device)
+        if "voice" in profile:
+            # stored with the profile, so the voice is not hashed again
+            conds._checksum = profile["voice"]
+        return conds
+
+    def remove(self, voice: str) -> bool:
+        """Deletes the profile of `voice` (a reference audio file or a profile name). Returns whether it existed."""
+        profile = self.find(voice)
+        if profile is None:
+            return False
+        os.remove(profile["path"])
+        return True
@@ -1,48 +1,101 @@
 import os
+from functools import lru_cache
 import torch
 import torchaudio
 import torchaudio.transforms as transforms
 from tqdm import tqdm
 
 #import text_preprocess from src subdirectory
+from src.manifest import RenderManifest
+from src.pipeline import AudiobookPipeline
 from src.text_preprocess import TextProcessor
 from src.text_to_speech import TextToSpeech
 fname = "input/MiJ.txt"
+voice = "input/reference1.wav"
+# the chunks of a paragraph are rendered by S3Gen in batches
+gen_params = dict(exaggeration=.6, cfg_weight=0.4, temperature=1., repetition_penalty=1.0, s3gen_batch_size=8)
 
-processor = TextProcessor()
-tts = TextToSpeech()
-tts.model.prepare_conditionals("input/reference1.wav")
 
-def check_spec(wav):
+@lru_cache(maxsize=None)
+def spec_transform():
     sample_rate=24000
-    transform = transforms.MelSpectrogram(sample_rate, n_fft=400, n_mels=128, hop_length=400)
-    mel_specgram = transform(wav).squeeze(0)
+    return transforms.MelSpectrogram(sample_rate, n_fft=400, n_mels=128, hop_length=400)
+
+
+def check_spec(wav):
+    mel_specgram = spec_transform()(wav).squeeze(0)
     total_energy = mel_specgram[120:,-100:].sum(axis=0).sum()
     return total_energy.detach().cpu().numpy()
 
 
-with open(os.path.join(os.path.dirname(__file__), fname), 'r', encoding='utf-8') as file:
-    text = file.read()
+def main():
+    # Chunks rendered before with the same voice and parameters (headings, repeated lines) come from the cache,
+    # and the voice conditionals are prepared once and then loaded from the voice library
+    tts = TextToSpeech(cache_path="output/audio_cache.sqlite", voice_library_path="output/voices")
+    tts.prepare_conditionals(voice, exaggeration=gen_params["exaggeration"])
+
+    with open(os.path.join(os.path.dirname(__file__), fname), 'r', encoding='utf-8') as file:
+        text = file.read()
+
+    # Re-runs append to the metrics and only render the chunks that are missing or changed
+    f = open("output/MiJ/result.csv",'a')
+    manifest = RenderManifest("output/MiJ/manifest.sqlite", book=fname, params=dict(voice=voice, **gen_params))
+
+    # text = text[:2000]
+    # Normalized sentences are memoized across runs and books
+    processor = TextProcessor(memo_path="output/normalization_memo.sqlite")
+    paragraphs = processor.paragraph_splitter(text)
+    progress = tqdm(total=len(paragraphs), desc="Paragraphs: ")
 
-f = open("output/MiJ/result.csv",'w')
+    def synthesize(chunks):
+        # All chunks of the paragraph are decoded as one batch
+        return tts.generate_speech(chunks, **gen_params)
 
-# text = text[:2000]
-paragraphs = processor.paragraph_splitter(text)
-for idx, paragraph in enumerate(tqdm(paragraphs, desc="Paragraphs: ")):
-    # Split each paragraph into manageable chunks for the TTS
-    chunks = processor.sentence_splitter(paragraph, max_chars=400)
-    normalized_list = processor.normalize(chunks)
+    def verify(chunks, wavs):
+        # The pipeline hands over the chunks of several paragraphs. Whisper transcribes them several clips per
+        # 30 s window, and the windows as one batch.
+        scores = tts.check_tts_packed(chunks, wavs)
+        return [(score, float(check_spec(wav))) for score, wav in zip(scores, wavs)]
 
-    wavout = []
-    for i, txt in enumerate(normalized_list):
-        wav = tts.generate_speech(txt, exaggeration=.6, cfg_weight=0.4, temperature=1., repetition_penalty=1.0)
-        diff = tts.check_tts(txt, wav)
-        noise = check_spec(wav)
-        f.write(f"{idx},{i},{diff},{noise}\n")
-        wavout.append(wav)
-    wavout=torch.hstack(wavout)
-    torchaudio.save(f"output/MiJ/{idx}.wav", wavout, 24000)
+    def write(idx, chunks, wavs, metrics):
+        for i, (diff, noise) in enumerate(metrics):
+            f.write(f"{idx},{i},{diff},{noise}\n")
+        f.flush()
+        wavout=torch.hstack(wavs)
+        output = f"output/MiJ/{idx}.wav"
+        torchaudio.save(output, wavout, 24000)
+        progress.update(1)
+        return output
 
+    # The whole book is normalized by one worker pool, verification and encoding run in background threads,
+    # so that they overlap with synthesis.
+    pipeline = AudiobookPipeline(synthesize, verify, write, manifest=manifest, on_skip=lambda idx: progress.update(1))
+    try:
+        # Chunks are packed by T3 text tokens, so that each fills the cache budget without overflowing it. How much
+        # speech a text token turns into depends on the voice, so it is measured (seeded) on plain sentences of the
+        # book, once: the manifest keeps the ratio, so that a resumed run splits the book into the same chunks and
+        # finds them in the manifest and the audio cache.
+        rate_key = f"speech_tokens_per_text_token/{tts.model.conds.checksum()}"
+        rate = manifest.get_value(rate_key)
+        if rate is None:
+            samples = [s for p in paragraphs[:50] for s in processor.sentence_splitter(p, max_len=300)
+                       if not processor.needs_normalization(s)][:8]
+            rate = tts.measure_speech_rate(samples, seed=0, cfg_weight=gen_params["cfg_weight"],
+                                           temperature=gen_params["temperature"],
+                                           repetition_penalty=gen_params["repetition_penalty"])
+            manifest.set_value(rate_key, rate)
+        budget = tts.text_token_budget(speech_tokens_per_text_token=rate)
+        pipeline.run(processor.iter_normalized_book(text, max_len=budget,
+                                                    length_fn=tts.count_text_tokens))
+    finally:
+        progress.close()
+        manifest.close()
+        print(f"Normalization: {processor.stats}, bypass rate {processor.bypass_rate:.0%}")
+        print(f"Audio cache: {tts.cache.stats}")
+        print(f"Verification windows: {tts.pack_stats}")
+        tts.cache.close()
+        f.close()
 
 
-    
+if __name__ == "__main__":
+    main()